@@ -1,21 +1,38 @@
+import asyncio
 import json
 import os
+import time
 import chainlit as cl
-import base64
 
 from opentelemetry import trace
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
 
-from assistant_flow.chat import chat_completion
+from assistant_flow.chat import achat_completion
+from assistant_flow.core import ImageEvent
+from session_store import get_session_store
+from warmup import warm_up_in_background
 
 from promptflow.tracing import start_trace
 from dotenv import load_dotenv
 import logging
 load_dotenv()
 
+# streamed text is sent to the browser in appends of at most this many seconds / characters
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", "0.05"))
+RENDER_MAX_CHARS = int(os.getenv("RENDER_MAX_CHARS", "2048"))
+
+# only the most recent turns of a conversation are kept in the session
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "20"))
+
+# pre-create the clients, pre-read the database and pre-build the prompt while the app
+# starts up rather than on the first message, see WARMUP in warmup.py
+warm_up_in_background()
+
 def setup_app_insights():
+    # the OpenTelemetry SDK and the exporters are only loaded when tracing is set up
+    from opentelemetry.sdk.trace import TracerProvider
+    from span_export import batch_processor, sampler, spans_file_exporter, tail_sampled
+
     from promptflow.tracing._integrations._openai_injector import inject_openai_api
     inject_openai_api()
 
@@ -23,8 +40,15 @@ def setup_app_insights():
     azmon_logger = logging.getLogger('azure')
     azmon_logger.setLevel(logging.WARNING)
 
-    # Set the Tracer Provider
-    trace.set_tracer_provider(TracerProvider())
+    # Set the Tracer Provider, head sampling drops whole traces before they are recorded.
+    # This has to run before start_trace(): a provider can only be set once and promptflow
+    # adds its resource to ours rather than replacing it
+    tracer_provider = TracerProvider(sampler=sampler())
+    trace.set_tracer_provider(tracer_provider)
+    if trace.get_tracer_provider() is not tracer_provider:
+        logging.warning("A tracer provider was already set, TRACE_SAMPLE_RATIO has no effect")
+    else:
+        print("using the following trace sampler", tracer_provider.sampler.get_description())
 
     from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
 
@@ -34,34 +58,43 @@ def setup_app_insights():
         connection_string=os.getenv('APPINSIGHTS_CONNECTION_STRING')
     )
 
-    # Add the Azure exporter to the tracer provider
+    # Add the Azure exporter to the tracer provider, batched so that ending a span
+    # doesn't wait for the network
     trace.get_tracer_provider().add_span_processor(
-        SimpleSpanProcessor(trace_exporter)
+        tail_sampled(batch_processor(trace_exporter))
     )
 
-    # Configure Console as the Exporter
-    file = open('spans.json', 'w')
-
-    # Configure Console as the Exporter and pass the file object
-    console_exporter = ConsoleSpanExporter(out=file)
-
-    # Add the console exporter to the tracer provider
-    trace.get_tracer_provider().add_span_processor(
-        SimpleSpanProcessor(console_exporter)
-    )
+    # Also keep the spans in a local, rotating JSON lines file
+    file_exporter = spans_file_exporter()
+    if file_exporter is not None:
+        trace.get_tracer_provider().add_span_processor(
+            tail_sampled(batch_processor(file_exporter))
+        )
     # Get a tracer
     return trace.get_tracer(__name__) 
 
+def session_id() -> str:
+    # the chainlit thread id survives reconnects, which may land on another worker
+    return cl.context.session.thread_id or cl.user_session.get("id")
+
+# the session store may wait on SQLite locks (even when it's created), so it's used from
+# a worker thread instead of stalling every chat on the event loop
+async def load_session() -> dict:
+    key = session_id()
+    return await asyncio.to_thread(lambda: get_session_store().get(key)) or new_session()
+
+async def save_session(session: dict) -> None:
+    key = session_id()
+    await asyncio.to_thread(lambda: get_session_store().put(key, session))
+
+def new_session() -> dict:
+    return {"chat_history": [], "last_message_context": None, "session_state": {}}
+
 @cl.on_chat_start
-def start_chat():
+async def start_chat():
     print("starting chat")
 
-    cl.user_session.set(
-        "chat_history",
-        [],
-    )
-    cl.user_session.set("last_message_context", None)
-    cl.user_session.set("session_state", {})    
+    await save_session(new_session())
 
 def show_images(image):
     elements = [
@@ -74,24 +107,26 @@ def show_images(image):
     return elements
 
 
-async def call_promptflow(chat_history, message):
+async def call_promptflow(session, message):
 
     tracer = trace.get_tracer(__name__)
     with tracer.start_as_current_span("call_promptflow") as span:
         carrier = {}
         # Write the current context into the carrier.
         TraceContextTextMapPropagator().inject(carrier)
-        cl.user_session.set("last_message_context", carrier)
+        session["last_message_context"] = carrier
+        await save_session(session)
 
         span.set_attribute("inputs", json.dumps({"question": message.content}))
         span.set_attribute("span_type", "function")
         span.set_attribute("framework", "promptflow")
         span.set_attribute("function", "call_promptflow")
 
-        session_state = cl.user_session.get("session_state")
+        session_state = session["session_state"]
 
-        response = await cl.make_async(chat_completion)(question=message.content,
-                                                        session_state=session_state)
+        # the async flow waits on the event loop, no thread is held per conversation
+        response = await achat_completion(question=message.content,
+                                          session_state=session_state)
         
         try:            
             span.set_attribute("output", json.dumps(response))
@@ -102,7 +137,7 @@ async def call_promptflow(chat_history, message):
 
 async def feedback(feedback_type):
     tracer = trace.get_tracer(__name__)
-    last_message_context = cl.user_session.get("last_message_context")
+    last_message_context = (await load_session())["last_message_context"]
     if last_message_context is None:
         await cl.Message(content=f"#### no last message set").send()
         return
@@ -120,7 +155,7 @@ async def feedback(feedback_type):
 @cl.on_message
 async def run_conversation(message: cl.Message):
     question = message.content 
-    chat_history = cl.user_session.get("chat_history")
+    session = await load_session()
  
     if question.startswith("/upvote"):
         await feedback("upvote")
@@ -133,38 +168,78 @@ async def run_conversation(message: cl.Message):
         msg = cl.Message(content="")
         await msg.send()
 
-        reply = await call_promptflow(chat_history, message)
+        reply = await call_promptflow(session, message)
         if "session_state" in reply:
-            cl.user_session.set("session_state", reply["session_state"])
-        stream = reply["chat_output"]
-        response = ""
-        images = []
-        for thing in stream:
-
-            if thing.strip().startswith("!["):
-                image = parse_image(thing.strip())
-                images.append(image)
-                msg.elements = images
-            else:
-                response += thing
-                msg.content = response
-            
-            await msg.update()
-        await msg.stream_token("🏁")
+            session["session_state"] = reply["session_state"]
+            await save_session(session)
+        response = await render(msg, reply["chat_output"])
         
-        chat_history.append({"inputs": {"question": message.content}, 
-                            "outputs": {"answer": response}})
+        chat_history = session["chat_history"] + [{"inputs": {"question": message.content},
+                                                   "outputs": {"answer": response}}]
+        session["chat_history"] = chat_history[-CHAT_HISTORY_TURNS:]
+        await save_session(session)
         
-def parse_image(thing):
-    # parse the image data from this inline markdown image
-    # ![](data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABgAAAAYCAYAAADgdz34AAABjElEQVRIS+2VvUoDQRSGv)
-    image = thing.split("(data:image/png;base64,")[1].split(")")[0]
-    data = base64.b64decode(image)
-    return cl.Image(content=data, name="generated image", display="inline", size="large")
+async def render(msg: cl.Message, stream) -> str:
+    """
+    Streams the assistant output into msg. Tokens are coalesced and sent as appends
+    once RENDER_INTERVAL has passed or RENDER_MAX_CHARS are pending, instead of
+    resending the whole message for every token. Returns the full text.
+    """
+    parts = []
+    pending = []
+    pending_size = 0
+    images = []
+
+    async def flush():
+        nonlocal pending_size
+        if pending:
+            await msg.stream_token("".join(pending))
+            pending.clear()
+            pending_size = 0
+
+    tokens = aiter(stream)
+    next_token = asyncio.ensure_future(anext(tokens))
+    last_flush = time.monotonic()
+    while True:
+        # wait for the next token, but not beyond the end of the current window; the
+        # pending read is never cancelled so no token is lost
+        timeout = max(0, last_flush + RENDER_INTERVAL - time.monotonic()) if pending else None
+        done, _ = await asyncio.wait({next_token}, timeout=timeout)
+        if not done:
+            await flush()
+            last_flush = time.monotonic()
+            continue
+
+        try:
+            thing = next_token.result()
+        except StopAsyncIteration:
+            break
+        next_token = asyncio.ensure_future(anext(tokens))
+
+        if isinstance(thing, ImageEvent):
+            # elements can't be appended, the image goes out with a full update
+            await flush()
+            images.append(
+                cl.Image(content=thing.content, mime=thing.mime_type, name="generated image", display="inline", size="large")
+            )
+            msg.elements = images
+            await msg.update()
+            last_flush = time.monotonic()
+        else:
+            parts.append(thing)
+            pending.append(thing)
+            pending_size += len(thing)
+            if pending_size >= RENDER_MAX_CHARS or time.monotonic() - last_flush >= RENDER_INTERVAL:
+                await flush()
+                last_flush = time.monotonic()
+
+    await flush()
+    await msg.stream_token("🏁")
+    return "".join(parts)
 
 if __name__ == "__main__":
-    start_trace()
     setup_app_insights()
+    start_trace()
 
     print("using the follwoing chat_model", os.getenv("OPENAI_CHAT_MODEL"))
 
@@ -0,0 +1,339 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+import asyncio
+import inspect
+import time
+import os
+import logging
+from typing import Any
+
+import httpx
+from openai import AsyncAzureOpenAI, NotFoundError
+
+from promptflow.tracing import trace
+from opentelemetry import trace as otel_trace
+
+from .core import (
+    ImageEvent,
+    QueuedIteratorStream,
+    log_step,
+    message_parts,
+    poll_status_action,
+    replace_thread,
+    run_request,
+    send_text,
+    start_tool_calls,
+    stream_event_action,
+    tool_error_output,
+    tool_function,
+    tool_outputs,
+    tool_timeout_output,
+    validated_threads,
+)
+
+# asyncio counterpart of core.AssistantsAPIGlue. The run is driven by a task on the
+# caller's event loop instead of a thread per message, so a waiting conversation
+# only costs a pending coroutine. Sync tools still run on the loop's worker threads.
+
+class AsyncAssistantsAPIGlue:
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        question: str,
+        session_state: dict[str, any] = {},
+        tools: dict[str, callable] = {},
+        run_mode: str = "stream",
+    ):
+        self.client = client
+        self.tools = tools
+        self.question = question
+        self.run_message = dict(role="user", content=question)
+        self.session_state = session_state or {}
+
+        self.max_waiting_time = 120
+        # a run event stream that stays silent this long is given up on
+        self.stream_read_timeout = 60
+
+        # "stream" consumes run events as they happen, "poll" is the fallback
+        # that checks the run status with exponential backoff
+        self.run_mode = run_mode
+        self.min_poll_interval = 0.25
+        self.max_poll_interval = 2.0
+        self.poll_backoff = 1.5
+
+        # tool calls of one step run concurrently, at most max_tool_workers at a time, and
+        # each must finish within tool_timeout seconds of starting
+        self.max_tool_workers = 4
+        self.tool_timeout = 60
+
+        if "OPENAI_ASSISTANT_ID" in os.environ:
+            self.assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
+        else:
+            raise Exception(
+                "You need to provide OPENAI_ASSISTANT_ID in the environment variables"
+            )
+        otel_trace.get_current_span().set_attribute("AssistantsAPIGlue_assistant_id", self.assistant_id)
+
+    async def setup_thread(self):
+        # looking up or creating the thread needs the network, so it can't live in __init__
+        if "thread_id" in self.session_state:
+            logging.info(f"Using thread_id from session_stat: {self.session_state['thread_id']}")
+            if self.session_state['thread_id'] in validated_threads:
+                self.thread_id = self.session_state['thread_id']
+            else:
+                self.thread_id = (await self.client.beta.threads.retrieve(self.session_state['thread_id'])).id
+                validated_threads.add(self.thread_id)
+        else:
+            logging.info("Creating a new thread")
+            self.thread_id = (await self.client.beta.threads.create()).id
+            validated_threads.add(self.thread_id)
+        otel_trace.get_current_span().set_attribute("AssistantsAPIGlue_thread_id", self.thread_id)
+
+        # the question is added to the thread by the run itself, see create_run()
+        self.session_state = {"thread_id": self.thread_id}
+
+    async def add_message(self, message):
+        _ = await self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role=message["role"],
+            content=message["content"],
+        )
+
+    @trace
+    async def run(self):
+        await self.setup_thread()
+        self.queue = AsyncQueuedIteratorStream()
+
+        # the task inherits the current trace context like every asyncio task
+        self.task = asyncio.create_task(self.run_inner())
+
+        return dict(
+            chat_output=self.queue.iter(),
+            session_state=self.session_state,
+            planner_raw_output=None
+        )
+
+    async def run_inner(self):
+        logging.info(f"Running the thread (run_mode={self.run_mode})")
+        try:
+            if self.run_mode == "stream":
+                await self.run_streaming()
+            elif self.run_mode == "poll":
+                await self.run_polling()
+            else:
+                raise ValueError(f"Unknown run mode: {self.run_mode}")
+        except Exception as e:
+            # nobody awaits the task, so tell the reader instead of failing silently
+            logging.exception("Run failed")
+            self.queue.send(f"\nThe assistant run failed: {e}\n")
+        finally:
+            # the reader of chat_output waits for the end of the stream, whatever happened
+            self.queue.end()
+
+    async def create_run(self, **kwargs):
+        try:
+            return await self.client.beta.threads.runs.create(
+                **run_request(self.thread_id, self.assistant_id, self.run_message, **kwargs)
+            )
+        except NotFoundError:
+            if not await self.thread_deleted():
+                raise
+            old_thread_id, self.thread_id = self.thread_id, (await self.client.beta.threads.create()).id
+            replace_thread(self.session_state, old_thread_id, self.thread_id)
+            return await self.client.beta.threads.runs.create(
+                **run_request(self.thread_id, self.assistant_id, self.run_message, **kwargs)
+            )
+
+    async def thread_deleted(self) -> bool:
+        try:
+            await self.client.beta.threads.retrieve(self.thread_id)
+            return False
+        except NotFoundError:
+            return True
+
+    async def run_streaming(self):
+        stream = await self.create_run(stream=True, timeout=self.stream_read_timeout)
+        self.queue.send(f"\nRunning message on Thread: {self.thread_id}\n")
+
+        start_time = time.time()
+        run_id = None
+
+        # submitting tool outputs hands back a new event stream for the same run
+        while stream is not None:
+            next_stream = None
+            try:
+                async for event in stream:
+                    logging.debug(f"Run event: {event.event}")
+
+                    if (time.time() - start_time) >= self.max_waiting_time:
+                        await stream.close()
+                        await self.cancel_run(run_id)
+                        return
+
+                    action = stream_event_action(event, self.queue)
+                    if action == "created":
+                        run_id = event.data.id
+
+                    elif action == "message_completed":
+                        await self.send_content(event.data, streamed=True)
+
+                    elif action == "completed":
+                        logging.info(f"Run completed (time={int(time.time() - start_time)}s)")
+                        await self.log_run_steps(event.data)
+                        self.queue.end()
+                        return
+
+                    elif action == "requires_action":
+                        next_stream = await self.submit_tool_outputs(
+                            event.data, stream=True, timeout=self.stream_read_timeout
+                        )
+
+            except httpx.TimeoutException:
+                await stream.close()
+                await self.cancel_run(run_id, f"stopped responding for {self.stream_read_timeout} seconds")
+                return
+
+            stream = next_stream
+
+        raise ValueError("Run event stream ended before the run completed")
+
+    async def run_polling(self):
+        run = await self.create_run()
+        logging.info(f"Run status: {run.status}")
+        self.queue.send(f"\nRunning message on Thread: {self.thread_id}\n")
+
+        start_time = time.time()
+        poll_interval = self.min_poll_interval
+        last_status = run.status
+
+        while (time.time() - start_time) < self.max_waiting_time:
+            run = await self.client.beta.threads.runs.retrieve(
+                thread_id=self.thread_id, run_id=run.id
+            )
+            logging.info(
+                f"Run status: {run.status} (time={int(time.time() - start_time)}s, max_waiting_time={self.max_waiting_time})"
+            )
+
+            if run.status != last_status:
+                poll_interval = self.min_poll_interval
+                last_status = run.status
+
+            action = poll_status_action(run.status, self.queue)
+            if action == "completed":
+                await self.complete_run(run)
+                return
+
+            elif action == "requires_action":
+                await self.submit_tool_outputs(run)
+
+            else:
+                remaining_time = self.max_waiting_time - (time.time() - start_time)
+                # unlike time.sleep this hands the event loop to the other sessions
+                await asyncio.sleep(max(0, min(poll_interval, remaining_time)))
+                poll_interval = min(poll_interval * self.poll_backoff, self.max_poll_interval)
+
+        await self.cancel_run(run.id)
+
+    async def submit_tool_outputs(self, run, **kwargs):
+        tool_call_outputs = await self.call_tools(run)
+        if not tool_call_outputs:
+            return None
+        return await self.client.beta.threads.runs.submit_tool_outputs(
+            thread_id=self.thread_id,
+            run_id=run.id,
+            tool_outputs=tool_call_outputs,
+            **kwargs,
+        )
+
+    async def cancel_run(self, run_id, reason=None):
+        reason = reason or f"did not answer within {self.max_waiting_time} seconds"
+        logging.warning(f"Run {run_id} {reason}, cancelling")
+        try:
+            await self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=run_id)
+        except Exception as e:
+            logging.warning(f"Could not cancel run {run_id}: {e}")
+        self.queue.send(f"\nThe assistant {reason}.\n")
+        self.queue.end()
+
+    async def complete_run(self, run):
+        await self.log_run_steps(run)
+
+        messages = (await self.client.beta.threads.messages.list(
+            thread_id=self.thread_id,
+            run_id=run.id,
+            order="desc",
+            limit=1,
+        )).data
+        logging.info(f"Run completed with {len(messages)} messages.")
+
+        if messages:
+            await self.send_content(messages[0])
+
+        self.queue.end()
+
+    async def log_run_steps(self, run):
+        run_steps = self.client.beta.threads.runs.steps.list(
+            thread_id=self.thread_id, run_id=run.id
+        )
+
+        steps = [step async for step in run_steps]
+        for step in reversed(steps):
+            log_step(step.model_dump())
+
+    async def send_content(self, message, streamed=False):
+        for kind, value in message_parts(message):
+            if kind == "text":
+                send_text(self.queue, value, streamed)
+            else:
+                response = await self.client.files.content(value)
+                self.queue.send(ImageEvent(value, await response.aread()))
+
+    async def call_tools(self, run):
+        tool_calls = start_tool_calls(run, self.queue)
+        if not tool_calls:
+            return []
+
+        semaphore = asyncio.Semaphore(self.max_tool_workers)
+
+        async def call_tool(tool_call):
+            tool_func, arguments = tool_function(self.tools, tool_call)
+            if inspect.iscoroutinefunction(tool_func):
+                return await tool_func(**arguments)
+            # blocking tools (SQLite, sync model clients) go to a worker thread,
+            # to_thread carries the trace context along
+            return await asyncio.to_thread(tool_func, **arguments)
+
+        async def call_tool_with_timeout(tool_call):
+            # the timeout starts once the call has a slot, waiting for one doesn't count
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(call_tool(tool_call), timeout=self.tool_timeout)
+                except asyncio.TimeoutError:
+                    return tool_timeout_output(tool_call, self.tool_timeout)
+                except Exception as e:
+                    return tool_error_output(tool_call, e)
+
+        results = await asyncio.gather(
+            *(call_tool_with_timeout(tool_call) for tool_call in tool_calls)
+        )
+        return tool_outputs(tool_calls, results)
+
+
+class AsyncQueuedIteratorStream(QueuedIteratorStream):
+
+    """QueuedIteratorStream read with `async for`, fed from the same event loop."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        # send(), send_delta() and end() only use put_nowait, which asyncio.Queue has too
+        self.queue = asyncio.Queue()
+
+    async def iter(self) -> Any:
+        while True:
+            token = await self.queue.get()
+
+            if token == self.terminate:
+                break
+
+            yield token
@@ -1,14 +1,19 @@
 import os
 import logging
+import threading
 
 # local imports
 from .core import AssistantsAPIGlue
+from .async_core import AsyncAssistantsAPIGlue
 from promptflow.tracing import start_trace, trace
-from openai import AzureOpenAI
-from sales_data_insights.main import SalesDataInsights
+from sales_data_insights.clients import get_async_client, get_client
 from typing import TypedDict
 
 
+sales_data_insights = None
+# the warm-up thread and the first request may both ask for the tools
+_tools_lock = threading.Lock()
+
 # You can get the same code with this link. https://aka.ms/2024-brk141​
 
 class AssistantStream(TypedDict):
@@ -40,6 +45,42 @@ def chat_completion(
         Returns: AssistantStream 
     """
 
+    check_env_vars()
+
+    client = get_client("azure_openai")
+
+    handler = AssistantsAPIGlue(client=client, 
+                                question=question, 
+                                session_state=session_state, 
+                                tools=get_tools(),
+                                run_mode=os.getenv("OPENAI_ASSISTANT_RUN_MODE", "stream"))
+    return handler.run()
+
+@trace
+async def achat_completion(
+    question: str,
+    session_state: dict = None,
+) -> AssistantStream:
+
+    """
+    Async entry point of the Assistant flow, same as chat_completion but the
+    chat_output is an async iterator and no thread is held while the run is waiting.
+    Args:
+        question (str): The question to ask the assistant.
+        session_state (dict, optional): The session state to resume from. Defaults to None.
+        Returns: AssistantStream 
+    """
+
+    check_env_vars()
+
+    handler = AsyncAssistantsAPIGlue(client=get_async_client(),
+                                     question=question,
+                                     session_state=session_state,
+                                     tools=get_tools(),
+                                     run_mode=os.getenv("OPENAI_ASSISTANT_RUN_MODE", "stream"))
+    return await handler.run()
+
+def check_env_vars():
     # verify all env vars are present
     required_env_vars = [
         "OPENAI_API_BASE",
@@ -56,19 +97,18 @@ def chat_completion(
         not missing_env_vars
     ), f"Missing environment variables: {missing_env_vars}"
 
-    global client
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("OPENAI_API_BASE"),
-        api_key=os.getenv("OPENAI_API_KEY"),
-        api_version=os.getenv("OPENAI_API_VERSION"),
-    )
-    sales_data_insights = SalesDataInsights()
-    
-    handler = AssistantsAPIGlue(client=client, 
-                                question=question, 
-                                session_state=session_state, 
-                                tools=dict(sales_data_insights=sales_data_insights))
-    return handler.run()
+def get_tools():
+    # one tool instance per process keeps its connection pool and SQL cache warm
+    global sales_data_insights
+    if sales_data_insights is None:
+        with _tools_lock:
+            if sales_data_insights is None:
+                # imported on the first tool setup, not when the app starts
+                from sales_data_insights.main import SalesDataInsights
+                sales_data_insights = SalesDataInsights(paged=True)
+
+    return dict(sales_data_insights=sales_data_insights,
+                sales_data_insights_next_page=sales_data_insights.next_page)
 
 def _test():
     """Test the chat completion function."""
@@ -1,22 +1,196 @@
 # enable type annotation syntax on Python versions earlier than 3.9
 from __future__ import annotations
 
+import base64
+import hashlib
 import time
 import os
+import threading
 import logging
 import json
 
-from openai import AzureOpenAI
+import httpx
+from openai import AzureOpenAI, NotFoundError
 
 from promptflow.tracing import trace
 from opentelemetry import trace as otel_trace
 from opentelemetry import context as otel_context
-from promptflow.contracts.multimedia import Image
 from threading import Thread
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from dataclasses import dataclass
 
 tracer = otel_trace.get_tracer(__name__)
 fun_emojis = ["🏃‍♂️", "🏃‍♀️", "🚶‍♂️", "🚶‍♀️", "🚶", "🏃", "🚶‍♂️", "🚶‍♀️", "🏃‍♂️", "🏃‍♀️"]
 
+class ValidatedThreads:
+
+    """
+    Thread ids that are known to exist, so a turn on a known thread doesn't need a
+    retrieve round trip first. Entries expire after ttl seconds; a thread that
+    disappears in the meantime is noticed when the run is created.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, thread_id: str) -> bool:
+        with self.lock:
+            validated = self.entries.get(thread_id)
+            if validated is None or time.time() - validated > self.ttl:
+                self.entries.pop(thread_id, None)
+                return False
+            return True
+
+    def add(self, thread_id: str) -> None:
+        with self.lock:
+            self.entries[thread_id] = time.time()
+            self.entries.move_to_end(thread_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, thread_id: str) -> None:
+        with self.lock:
+            self.entries.pop(thread_id, None)
+
+validated_threads = ValidatedThreads(ttl=float(os.getenv("THREAD_CACHE_TTL", "3600")))
+
+
+# Run handling shared by AssistantsAPIGlue and async_core.AsyncAssistantsAPIGlue. These
+# only look at events, statuses, messages and tool calls; the glue classes do the I/O.
+
+RUN_FAILED_EVENTS = ["thread.run.cancelled", "thread.run.expired", "thread.run.failed"]
+RUN_PROGRESS_EVENTS = ["thread.run.queued", "thread.run.in_progress", "thread.run.step.created"]
+
+
+def run_request(thread_id: str, assistant_id: str, run_message: dict, **kwargs) -> dict:
+    # the user message goes in with the run, one request instead of messages.create + runs.create
+    return dict(thread_id=thread_id, assistant_id=assistant_id, additional_messages=[run_message], **kwargs)
+
+
+def replace_thread(session_state: dict, old_thread_id: str, new_thread_id: str) -> None:
+    # the thread was deleted since we last saw it, the conversation continues on a new one
+    logging.warning(f"Thread {old_thread_id} not found, continuing on thread {new_thread_id}")
+    validated_threads.discard(old_thread_id)
+    validated_threads.add(new_thread_id)
+    session_state["thread_id"] = new_thread_id
+    otel_trace.get_current_span().set_attribute("AssistantsAPIGlue_thread_id", new_thread_id)
+
+
+def stream_event_action(event, queue: QueuedIteratorStream) -> str | None:
+    """
+    Handles a run stream event as far as no I/O is needed and returns what is left for
+    the glue: "created", "message_completed", "completed", "requires_action" or None.
+    Raises for failed runs.
+    """
+    if event.event == "thread.run.created":
+        return "created"
+
+    elif event.event == "thread.message.delta":
+        # forward the text as it is generated, the finished message
+        # is collected for the trace on thread.message.completed
+        for content in event.data.delta.content or []:
+            if content.type == "text" and content.text and content.text.value:
+                queue.send_delta(content.text.value)
+
+    elif event.event == "thread.message.completed":
+        return "message_completed"
+
+    elif event.event == "thread.run.completed":
+        return "completed"
+
+    elif event.event == "thread.run.requires_action":
+        return "requires_action"
+
+    elif event.event in RUN_FAILED_EVENTS:
+        raise ValueError(f"Run failed with status: {event.data.status}")
+
+    elif event.event in RUN_PROGRESS_EVENTS:
+        queue.send(".")
+
+    elif event.event == "error":
+        raise ValueError(f"Run failed with error: {event.data}")
+
+    return None
+
+
+def poll_status_action(status: str, queue: QueuedIteratorStream) -> str:
+    """
+    What to do about a polled run status: "completed", "requires_action" or "wait".
+    Raises for failed runs.
+    """
+    if status in ["completed", "requires_action"]:
+        return status
+    elif status in ["cancelled", "expired", "failed"]:
+        raise ValueError(f"Run failed with status: {status}")
+    elif status in ["in_progress", "queued"]:
+        # fun running emoji
+        # queue.send(f"{fun_emojis[int(time.time()) % len(fun_emojis)]}")
+        queue.send(".")
+        return "wait"
+    raise ValueError(f"Unknown run status: {status}")
+
+
+def message_parts(message) -> list[tuple[str, str]]:
+    # ("text", text) and ("image_file", file_id) in message order, images have to be downloaded
+    parts = []
+    for content in message.content:
+        if content.type == "text":
+            parts.append(("text", content.text.value))
+        elif content.type == "image_file":
+            parts.append(("image_file", content.image_file.file_id))
+        else:
+            logging.critical("Unknown content type: {}".format(content.type))
+    return parts
+
+
+def send_text(queue: QueuedIteratorStream, text: str, streamed: bool) -> None:
+    if streamed:
+        # the text already reached the queue as deltas
+        queue.collect(text)
+    else:
+        queue.send(text)
+
+
+def start_tool_calls(run, queue: QueuedIteratorStream) -> list:
+    """Traces and announces the tool calls a run asks for and returns them."""
+    tool_calls = run.required_action.submit_tool_outputs.tool_calls or []
+    for tool_call in tool_calls:
+        trace_tool(tool_call.model_dump())
+        queue.send(f"\nTool call: {tool_call.function.name} with arguments: {tool_call.function.arguments}\n")
+
+        if tool_call.type != "function":
+            raise ValueError(f"Unsupported tool call type: {tool_call.type}")
+    return tool_calls
+
+
+def tool_function(tools: dict[str, callable], tool_call) -> tuple[callable, dict]:
+    return tools[tool_call.function.name], json.loads(tool_call.function.arguments)
+
+
+def tool_timeout_output(tool_call, timeout: float) -> dict:
+    logging.warning(f"Tool call {tool_call.id} timed out after {timeout}s")
+    return {"error": f"Tool call timed out after {timeout} seconds"}
+
+
+def tool_error_output(tool_call, e: Exception) -> dict:
+    logging.exception(f"Tool call {tool_call.id} failed")
+    return {"error": f"{e}"}
+
+
+def tool_outputs(tool_calls: list, results: list) -> list[dict]:
+    return [
+        {
+            "tool_call_id": tool_call.id,
+            "output": json.dumps(tool_call_output),
+        }
+        for tool_call, tool_call_output in zip(tool_calls, results)
+    ]
+
+
 class AssistantsAPIGlue:
     def __init__(
         self,
@@ -24,6 +198,7 @@ class AssistantsAPIGlue:
         question: str,
         session_state: dict[str, any] = {},
         tools: dict[str, callable] = {},
+        run_mode: str = "stream",
     ):
         # Provision an AzureOpenAI client for the assistants
         logging.info("Creating AzureOpenaI client")
@@ -31,19 +206,41 @@ class AssistantsAPIGlue:
         self.tools = tools
 
         self.max_waiting_time = 120
-
+        # a run event stream that stays silent this long is given up on
+        self.stream_read_timeout = 60
+
+        # "stream" consumes run events as they happen, "poll" is the fallback
+        # that checks the run status with exponential backoff
+        self.run_mode = run_mode
+        self.min_poll_interval = 0.25
+        self.max_poll_interval = 2.0
+        self.poll_backoff = 1.5
+
+        # tool calls of one step run concurrently, at most max_tool_workers at a time, and
+        # each must finish within tool_timeout seconds of starting
+        self.max_tool_workers = 4
+        self.tool_timeout = 60
+
+        session_state = session_state or {}
         if "thread_id" in session_state:
             logging.info(f"Using thread_id from session_stat: {session_state['thread_id']}")
             otel_trace.get_current_span().set_attribute("AssistantsAPIGlue_thread_id",  session_state['thread_id'])
-            self.thread_id = self.client.beta.threads.retrieve(session_state['thread_id']).id
+            if session_state['thread_id'] in validated_threads:
+                self.thread_id = session_state['thread_id']
+            else:
+                self.thread_id = self.client.beta.threads.retrieve(session_state['thread_id']).id
+                validated_threads.add(self.thread_id)
         else:
-            logging.info(f"Creating a new thread")
+            logging.info("Creating a new thread")
             self.thread_id = self.client.beta.threads.create().id
+            validated_threads.add(self.thread_id)
             otel_trace.get_current_span().set_attribute("AssistantsAPIGlue_thread_id", self.thread_id)
 
-        # Add last message in the thread
-        logging.info("Adding message in the thread")
-        self.add_message(dict(role="user", content=question))
+        # the question is added to the thread by the run itself, see create_run()
+        self.question = question
+        self.run_message = dict(role="user", content=question)
+        # returned to the caller and updated if the thread has to be replaced
+        self.session_state = {"thread_id": self.thread_id}
 
         if "OPENAI_ASSISTANT_ID" in os.environ:
             logging.info(
@@ -85,31 +282,115 @@ class AssistantsAPIGlue:
         
         return dict(
             chat_output=self.queue.iter(),
-            session_state={ "thread_id": self.thread_id },
+            session_state=self.session_state,
             planner_raw_output=None
         )
         
 
 
     def run_inner(self, messages=None):
-        if messages:
-            logging.info("Adding last message in the thread")
-            _ = self.client.beta.threads.messages.create(
-                thread_id=self.thread_id,
-                role=messages[-1]["role"],
-                content=messages[-1]["content"],
+        try:
+            if messages:
+                # the last message goes in with the run in place of the question
+                logging.info("Adding last message in the thread")
+                self.run_message = dict(role=messages[-1]["role"], content=messages[-1]["content"])
+
+            # Run the thread
+            logging.info(f"Running the thread (run_mode={self.run_mode})")
+            if self.run_mode == "stream":
+                self.run_streaming()
+            elif self.run_mode == "poll":
+                self.run_polling()
+            else:
+                raise ValueError(f"Unknown run mode: {self.run_mode}")
+        except Exception as e:
+            # nobody joins the run thread, so tell the reader instead of dying silently
+            logging.exception("Run failed")
+            self.queue.send(f"\nThe assistant run failed: {e}\n")
+        finally:
+            # the reader of chat_output waits for the end of the stream, whatever happened
+            self.queue.end()
+
+    def create_run(self, **kwargs):
+        try:
+            return self.client.beta.threads.runs.create(
+                **run_request(self.thread_id, self.assistant_id, self.run_message, **kwargs)
+            )
+        except NotFoundError:
+            # a 404 can also be about the assistant or the deployment, the conversation only
+            # moves to a new thread when the thread itself is gone
+            if not self.thread_deleted():
+                raise
+            old_thread_id, self.thread_id = self.thread_id, self.client.beta.threads.create().id
+            replace_thread(self.session_state, old_thread_id, self.thread_id)
+            return self.client.beta.threads.runs.create(
+                **run_request(self.thread_id, self.assistant_id, self.run_message, **kwargs)
             )
 
-        # Run the thread
-        logging.info("Running the thread")
-        run = self.client.beta.threads.runs.create(
-            thread_id=self.thread_id,
-            assistant_id=self.assistant_id,
-        )
+    def thread_deleted(self) -> bool:
+        try:
+            self.client.beta.threads.retrieve(self.thread_id)
+            return False
+        except NotFoundError:
+            return True
+
+    def run_streaming(self):
+        # consume the run events as the service emits them, no sleeping in between
+        # the read timeout bounds the wait for the next event, max_waiting_time is only
+        # checked when one arrives
+        stream = self.create_run(stream=True, timeout=self.stream_read_timeout)
+        self.queue.send(f"\nRunning message on Thread: {self.thread_id}\n")
+
+        start_time = time.time()
+        run_id = None
+
+        # submitting tool outputs hands back a new event stream for the same run
+        while stream is not None:
+            next_stream = None
+            try:
+                for event in stream:
+                    logging.debug(f"Run event: {event.event}")
+
+                    if (time.time() - start_time) >= self.max_waiting_time:
+                        stream.close()
+                        self.cancel_run(run_id)
+                        return
+
+                    action = stream_event_action(event, self.queue)
+                    if action == "created":
+                        run_id = event.data.id
+
+                    elif action == "message_completed":
+                        self.send_content(event.data, streamed=True)
+
+                    elif action == "completed":
+                        logging.info(f"Run completed (time={int(time.time() - start_time)}s)")
+                        self.log_run_steps(event.data)
+                        self.queue.end()
+                        return
+
+                    elif action == "requires_action":
+                        next_stream = self.submit_tool_outputs(
+                            event.data, stream=True, timeout=self.stream_read_timeout
+                        )
+
+            except httpx.TimeoutException:
+                stream.close()
+                self.cancel_run(run_id, f"stopped responding for {self.stream_read_timeout} seconds")
+                return
+
+            stream = next_stream
+
+        raise ValueError("Run event stream ended before the run completed")
+
+    def run_polling(self):
+        run = self.create_run()
         logging.info(f"Run status: {run.status}")
         self.queue.send(f"\nRunning message on Thread: {self.thread_id}\n")
 
         start_time = time.time()
+        poll_interval = self.min_poll_interval
+        last_status = run.status
 
         # loop until max_waiting_time is reached
         while (time.time() - start_time) < self.max_waiting_time:
@@ -121,87 +402,132 @@ class AssistantsAPIGlue:
                 f"Run status: {run.status} (time={int(time.time() - start_time)}s, max_waiting_time={self.max_waiting_time})"
             )
 
-            if run.status == "completed":
-                # check run steps
-                run_steps = self.client.beta.threads.runs.steps.list(
-                    thread_id=self.thread_id, run_id=run.id #, after=step_logging_cursor
-                )
-
-                for step in reversed(list(run_steps)):
-                    log_step(step.model_dump())
-
-                messages = []
-                for message in self.client.beta.threads.messages.list(
-                    thread_id=self.thread_id
-                ):
-                    message = self.client.beta.threads.messages.retrieve(
-                        thread_id=self.thread_id, message_id=message.id
-                    )
-                    messages.append(message)
-                logging.info(f"Run completed with {len(messages)} messages.")
-
-                final_message = messages[0]
-
-                mixed_response = []
-
-                for message in final_message.content:
-                    if message.type == "text":
-                        mixed_response.append(message.text.value)
-                    elif message.type == "image_file":
-                        file_id = message.image_file.file_id
-                        mixed_response.append(
-                            Image(self.client.files.content(file_id).read())
-                        )
-                    else:
-                        logging.critical("Unknown content type: {}".format(message.type))
-
-                for response in mixed_response:
-                    self.queue.send(response)
-                
-                self.queue.end()
+            # poll quickly right after a state change, then back off while nothing happens
+            if run.status != last_status:
+                poll_interval = self.min_poll_interval
+                last_status = run.status
 
+            action = poll_status_action(run.status, self.queue)
+            if action == "completed":
+                self.complete_run(run)
                 return
-            
-            elif run.status == "requires_action":
+
+            elif action == "requires_action":
                 # if the run requires us to run a tool
-                tool_call_outputs = []
+                self.submit_tool_outputs(run)
 
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    trace_tool(tool_call.model_dump())
-                    self.queue.send(f"\nTool call: {tool_call.function.name} with arguments: {tool_call.function.arguments}\n")
+            else:
+                remaining_time = self.max_waiting_time - (time.time() - start_time)
+                time.sleep(max(0, min(poll_interval, remaining_time)))
+                poll_interval = min(poll_interval * self.poll_backoff, self.max_poll_interval)
 
-                    if tool_call.type == "function":
-                        tool_func = self.tools[tool_call.function.name]
-                        tool_call_output = tool_func(
-                            **json.loads(tool_call.function.arguments)
-                        )
+        self.cancel_run(run.id)
 
-                        tool_call_outputs.append(
-                            {
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps(tool_call_output),
-                            }
-                        )
-                    else:
-                        raise ValueError(f"Unsupported tool call type: {tool_call.type}")
-
-                if tool_call_outputs:
-                    _ = self.client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=self.thread_id,
-                        run_id=run.id,
-                        tool_outputs=tool_call_outputs,
-                    )
-            elif run.status in ["cancelled", "expired", "failed"]:
-                raise ValueError(f"Run failed with status: {run.status}")
-
-            elif run.status in ["in_progress", "queued"]:
-                # fun running emoji                
-                # self.queue.send(f"{fun_emojis[int(time.time()) % len(fun_emojis)]}")
-                self.queue.send(".")
-                time.sleep(2)
+    def submit_tool_outputs(self, run, **kwargs):
+        tool_call_outputs = self.call_tools(run)
+        if not tool_call_outputs:
+            return None
+        return self.client.beta.threads.runs.submit_tool_outputs(
+            thread_id=self.thread_id,
+            run_id=run.id,
+            tool_outputs=tool_call_outputs,
+            **kwargs,
+        )
 
+    def cancel_run(self, run_id, reason=None):
+        reason = reason or f"did not answer within {self.max_waiting_time} seconds"
+        logging.warning(f"Run {run_id} {reason}, cancelling")
+        try:
+            self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=run_id)
+        except Exception as e:
+            logging.warning(f"Could not cancel run {run_id}: {e}")
+        self.queue.send(f"\nThe assistant {reason}.\n")
+        self.queue.end()
+
+    def complete_run(self, run):
+        self.log_run_steps(run)
+
+        # only the newest message of this run is shown, so a single page of one
+        # message is all we need regardless of how long the thread is
+        messages = self.client.beta.threads.messages.list(
+            thread_id=self.thread_id,
+            run_id=run.id,
+            order="desc",
+            limit=1,
+        ).data
+        logging.info(f"Run completed with {len(messages)} messages.")
+
+        if messages:
+            final_message = messages[0]
+            self.send_content(final_message)
+
+        self.queue.end()
+
+    def log_run_steps(self, run):
+        # check run steps
+        run_steps = self.client.beta.threads.runs.steps.list(
+            thread_id=self.thread_id, run_id=run.id #, after=step_logging_cursor
+        )
+
+        for step in reversed(list(run_steps)):
+            log_step(step.model_dump())
+
+    def send_content(self, message, streamed=False):
+        for kind, value in message_parts(message):
+            if kind == "text":
+                send_text(self.queue, value, streamed)
             else:
-                raise ValueError(f"Unknown run status: {run.status}")
+                # the bytes go through the stream as they are, no base64 round trip
+                self.queue.send(ImageEvent(value, self.client.files.content(value).read()))
+
+    def call_tools(self, run):
+        tool_calls = start_tool_calls(run, self.queue)
+        if not tool_calls:
+            return []
+
+        # run all tool calls of the step concurrently in the current trace context
+        current_context = otel_context.get_current()
+
+        def call_tool_with_context(tool_call):
+            token = otel_context.attach(current_context)
+            try:
+                tool_func, arguments = tool_function(self.tools, tool_call)
+                return tool_func(**arguments)
+            finally:
+                otel_context.detach(token)
+
+        # calls are handed out here rather than queued in the executor, so a call's timeout
+        # starts when it does; a timed out call can't be stopped, its thread is left to
+        # finish and the next call gets a thread of its own
+        executor = ThreadPoolExecutor(max_workers=len(tool_calls), thread_name_prefix="tool_call")
+        pending = list(enumerate(tool_calls))
+        running = {}
+        results = [None] * len(tool_calls)
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_tool_workers:
+                    i, tool_call = pending.pop(0)
+                    running[executor.submit(call_tool_with_context, tool_call)] = (i, time.time())
+
+                first_deadline = min(started for _, started in running.values()) + self.tool_timeout
+                done, _ = wait(running, timeout=max(0, first_deadline - time.time()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, _ = running.pop(future)
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        results[i] = tool_error_output(tool_calls[i], e)
+
+                now = time.time()
+                for future, (i, started) in list(running.items()):
+                    if now - started >= self.tool_timeout:
+                        del running[future]
+                        results[i] = tool_timeout_output(tool_calls[i], self.tool_timeout)
+        finally:
+            # don't wait for timed out tool calls, their results are not used anymore
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return tool_outputs(tool_calls, results)
 
 def log_step(step):
     logging.info(
@@ -235,29 +561,69 @@ from typing import Any, Dict, List
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
 from opentelemetry import trace
 
+@dataclass
+class ImageEvent:
+
+    """
+    An image the assistant produced, e.g. a code interpreter chart. It travels through
+    the stream as raw bytes, the trace only records reference().
+    """
+
+    file_id: str
+    content: bytes
+    mime_type: str = "image/png"
+
+    def reference(self) -> dict:
+        return {
+            "type": "image",
+            "file_id": self.file_id,
+            "mime_type": self.mime_type,
+            "size": len(self.content),
+            "sha256": hashlib.sha256(self.content).hexdigest(),
+        }
+
+    def __str__(self) -> str:
+        # consumers that only handle text still get an inline markdown image
+        return f"\n\n![](data:{self.mime_type};base64,{base64.b64encode(self.content).decode()})\n\n"
+
 class QueuedIteratorStream:
     terminate: str = "<--terminate-->"
-    queue: queue.Queue[str]
-    output: List[str]
+    queue: queue.Queue[str | ImageEvent]
+    output: List[str | dict]
     context_carrier: Dict[str, Any]
 
     def __init__(self) -> None:
         self.queue = queue.Queue()
         self.output = []
+        self.ended = False
         self.context_carrier = {}
         # Write the current context into the carrier.
         TraceContextTextMapPropagator().inject(self.context_carrier)
 
-    def send(self, event: str) -> None:
+    def send(self, event: str | ImageEvent) -> None:
         if event is not None and event != "":
-            if isinstance(event, Image):
-                self.output.append(event.to_base64(with_type=True))
-                self.queue.put_nowait(f"\n\n![]({event.to_base64(with_type=True)})\n\n")
+            if isinstance(event, ImageEvent):
+                self.output.append(event.reference())
+                self.queue.put_nowait(event)
             else:
                 self.output.append(event)
                 self.queue.put_nowait(f"{event}")
 
+    def send_delta(self, delta: str) -> None:
+        # partial text is only streamed, use collect() to record the finished text
+        if delta:
+            self.queue.put_nowait(delta)
+
+    def collect(self, event: str) -> None:
+        if event is not None and event != "":
+            self.output.append(event)
+
     def end(self) -> None:
+        # the run ends the stream when it finishes and once more on the way out
+        if self.ended:
+            return
+        self.ended = True
+
         tracer = trace.get_tracer(__name__)
         ctx = TraceContextTextMapPropagator().extract(carrier=self.context_carrier)
 
@@ -60,7 +60,10 @@ tools = [
   If you are unsure of the data available, you can ask for a list of categories, days, etc.
   - query for all the values for the main_category
   The data will be returned in a json format in the data property of the returned object with the query used 
-  to get the data in the query property.
+  to get the data in the query property. The data is column oriented: "columns" lists the column names once,
+  "values" holds one list of values per column and "types" the type of each column. If "truncated" is true,
+  only the first "rows" rows were returned; use sales_data_insights_next_page with the returned "next_page_token"
+  to get the following rows, or ask a more specific or more aggregated question.
   If a query cannot be answered, the tool will return a message in the error property of the returned object. 
             """,
             "parameters": {
@@ -74,6 +77,26 @@ tools = [
                 "required": ["question"],
             },
         },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "sales_data_insights_next_page",
+            "description": """
+   get the next page of rows of a sales_data_insights result that was truncated. The result has the same structure
+   as the sales_data_insights result and contains a new next_page_token as long as there are more rows.
+            """,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "page_token": {
+                        "type": "string",
+                        "description": "The next_page_token returned in the data property of the previous result.",
+                    }
+                },
+                "required": ["page_token"],
+            },
+        },
     }
 ]
 
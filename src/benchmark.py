@@ -0,0 +1,242 @@
+import argparse
+import glob
+import json
+import os
+import pathlib
+import sys
+import time
+from types import SimpleNamespace
+
+# Latency benchmark of the SalesDataInsights pipeline over the test sets. Every question
+# is answered once per repeat and the time spent in each stage is recorded:
+#
+#   prompt     building the system prompt (also for the SQL cache key)
+#   fast_path  matching the question against the local templates
+#   generate   the model call(s), including retries
+#   query_db   running the query
+#   other      everything else in __call__
+#
+# Stage times are exclusive, a stage running inside another one isn't counted twice,
+# so the stages add up to the total. With model_type "replay" (the default) the model
+# is replaced by recorded completions, see sales_data_insights/replay.py.
+#
+#   python benchmark.py --seed-ground-truth                 # recordings from the test sets
+#   python benchmark.py --record azure_openai               # recordings from a live model
+#   python benchmark.py --latency lognormal:900,0.4 --save benchmark_baseline.json
+#   python benchmark.py --latency lognormal:900,0.4 --baseline benchmark_baseline.json
+
+DATA_DIR = os.path.join(pathlib.Path(__file__).parent.resolve(), "generate_data")
+STAGES = ["prompt", "fast_path", "generate", "query_db", "other", "total"]
+PERCENTILES = [50, 95, 99]
+
+
+def test_sets(data: str) -> dict[str, str]:
+    # "mini,small" or file names, all test_set_*.jsonl by default
+    if not data:
+        paths = sorted(glob.glob(os.path.join(DATA_DIR, "test_set_*.jsonl")))
+    else:
+        paths = [
+            name if name.endswith(".jsonl") else os.path.join(DATA_DIR, f"test_set_{name}.jsonl")
+            for name in data.split(",")
+        ]
+    return {pathlib.Path(path).stem.removeprefix("test_set_"): path for path in paths}
+
+
+def load_test_set(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class StageTimer:
+
+    """
+    Wraps methods so that the exclusive time spent in them is added to the stages of
+    the current question.
+    """
+
+    def __init__(self):
+        self.stages = None
+        self.stack = []
+
+    def wrap(self, stage: str, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            self.stack.append(0.0)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+                if self.stages is not None:
+                    self.stages[stage] = self.stages.get(stage, 0.0) + (elapsed - nested) * 1000
+        return timed
+
+    def instrument(self, sales_data_insights) -> None:
+        # instance attributes shadow the methods, __call__ picks them up through self
+        sdi = sales_data_insights
+        sdi.system_prompt = self.wrap("prompt", sdi.system_prompt)
+        sdi.generate_query_with_retry = self.wrap("generate", sdi.generate_query_with_retry)
+        sdi.query_db = self.wrap("query_db", sdi.query_db)
+
+        fast_path_matcher = sdi.fast_path_matcher
+        sdi.fast_path_matcher = lambda: SimpleNamespace(match=self.wrap("fast_path", fast_path_matcher().match))
+
+
+def percentile(values: list[float], p: float) -> float:
+    # linear interpolation between the closest ranks
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(samples: list[dict]) -> dict:
+    summary = {}
+    for stage in STAGES:
+        values = [sample[stage] for sample in samples if stage in sample]
+        if values:
+            summary[stage] = {"count": len(values), **{f"p{p}": round(percentile(values, p), 3) for p in PERCENTILES}}
+    return summary
+
+
+def run(sales_data_insights, questions: list[str], repeat: int, cold: bool) -> tuple[list[dict], int]:
+    from sales_data_insights.cache import ResultCache, SqlCache
+
+    timer = StageTimer()
+    timer.instrument(sales_data_insights)
+    samples = []
+    errors = 0
+    for _ in range(repeat):
+        for question in questions:
+            if cold:
+                # every question pays for generation and the query, as on first sight
+                sales_data_insights.sql_cache = SqlCache(max_entries=0)
+                sales_data_insights.result_cache = ResultCache(max_bytes=0)
+            timer.stages = {}
+            start = time.perf_counter()
+            try:
+                result = sales_data_insights(question=question)
+            except Exception as e:
+                result = {"error": f"{e}"}
+            total = (time.perf_counter() - start) * 1000
+            if result.get("error") not in (None, "None"):
+                errors += 1
+                print(f"error: {question!r}: {result['error']}")
+                continue
+            stages = timer.stages
+            stages["other"] = max(0.0, total - sum(stages.values()))
+            stages["total"] = total
+            samples.append(stages)
+    return samples, errors
+
+
+def report(result: dict) -> None:
+    print(f"model {result['model']}, latency {result['latency']}, {result['repeat']} repeats")
+    for name, data_set in result["sets"].items():
+        print(f"\n{name}: {data_set['questions']} questions, {data_set['errors']} errors")
+        print(f"  {'stage':<10} {'count':>6} " + " ".join(f"{f'p{p} ms':>10}" for p in PERCENTILES))
+        for stage, stats in data_set["stages"].items():
+            print(f"  {stage:<10} {stats['count']:>6} " + " ".join(f"{stats[f'p{p}']:>10.1f}" for p in PERCENTILES))
+
+
+def compare(result: dict, baseline: dict, tolerance: float, min_ms: float) -> list[str]:
+    for setting in ["model", "latency", "cold", "fast_path"]:
+        if result[setting] != baseline.get(setting):
+            print(f"WARNING baseline {setting} was {baseline.get(setting)}, now {result[setting]}")
+
+    regressions = []
+    for name, data_set in result["sets"].items():
+        before_set = baseline["sets"].get(name)
+        if before_set is None:
+            continue
+        for stage, stats in data_set["stages"].items():
+            before = before_set["stages"].get(stage)
+            if before is None:
+                continue
+            for p in PERCENTILES:
+                now, was = stats[f"p{p}"], before[f"p{p}"]
+                # sub millisecond stages jitter too much to compare
+                if now > min_ms and now > was * (1 + tolerance):
+                    regressions.append(f"{name} {stage} p{p}: {was:.1f} -> {now:.1f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", help="Test sets, comma separated names ('mini', 'small', 'large') or files, all by default")
+    parser.add_argument("--model", help="Model type to benchmark", default="replay")
+    parser.add_argument("--db", help="SQLite database to query, order_data.db by default")
+    parser.add_argument("--recordings", help="Recorded completions for the replay model (REPLAY_RECORDINGS)")
+    parser.add_argument("--latency", help="Simulated model latency for the replay model (REPLAY_LATENCY)")
+    parser.add_argument("--seed", help="Random seed for the simulated latency (REPLAY_SEED)", type=int, default=0)
+    parser.add_argument("--repeat", help="Times every question is answered", type=int, default=3)
+    parser.add_argument("--warm", help="Keep the SQL and result caches between questions", action="store_true")
+    parser.add_argument("--no-fast-path", help="Send every question to the model", action="store_true")
+    parser.add_argument("--record", help="Record completions from this live model type into the recordings and exit")
+    parser.add_argument("--seed-ground-truth", help="Write the ground truth queries as recordings and exit", action="store_true")
+    parser.add_argument("--save", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against results saved with --save")
+    parser.add_argument("--tolerance", help="Allowed relative slowdown per percentile", type=float, default=0.25)
+    parser.add_argument("--min-ms", help="Ignore percentiles below this many ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # the replay client reads its settings from the environment when it's created
+    if args.recordings:
+        os.environ["REPLAY_RECORDINGS"] = args.recordings
+    if args.latency:
+        os.environ["REPLAY_LATENCY"] = args.latency
+    os.environ["REPLAY_SEED"] = str(args.seed)
+
+    from sales_data_insights.main import SalesDataInsights
+    from sales_data_insights.replay import DEFAULT_RECORDINGS, record, recordings_from_test_set, save_recordings
+
+    sets = {name: load_test_set(path) for name, path in test_sets(args.data).items()}
+    recordings_path = os.getenv("REPLAY_RECORDINGS", DEFAULT_RECORDINGS)
+
+    if args.seed_ground_truth or args.record:
+        rows = [row for rows in sets.values() for row in rows]
+        if args.record:
+            recordings = record(SalesDataInsights(data=args.db, model_type=args.record), [row["question"] for row in rows])
+        else:
+            recordings = recordings_from_test_set(rows)
+        save_recordings(recordings_path, recordings)
+        print(f"{len(recordings)} recordings written to {recordings_path}")
+        sys.exit(0)
+
+    sales_data_insights = SalesDataInsights(data=args.db, model_type=args.model,
+                                            fast_path=not args.no_fast_path)
+    # building the prompt and the fast path once up front is startup work, not per question
+    sales_data_insights.fast_path_matcher()
+
+    result = {
+        "model": args.model,
+        "latency": os.getenv("REPLAY_LATENCY", "recorded") if args.model == "replay" else "live",
+        "repeat": args.repeat,
+        "cold": not args.warm,
+        "fast_path": not args.no_fast_path,
+        "sets": {},
+    }
+    for name, rows in sets.items():
+        samples, errors = run(sales_data_insights, [row["question"] for row in rows], args.repeat, not args.warm)
+        result["sets"][name] = {"questions": len(rows), "errors": errors, "stages": summarize(samples)}
+
+    report(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.min_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,277 @@
+import json
+import math
+import os
+import pathlib
+import sqlite3
+import statistics
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from sales_data_insights.db import ReadOnlyConnectionPool
+from sales_data_insights.watchdog import deadline
+
+# Execution based SQL grading: the generated query and the ground truth query both run
+# against order_data.db and their result sets are compared, no LLM judge involved.
+#
+# Results are compared as multisets of rows, so row order doesn't matter. Column names
+# are ignored and columns are matched by their values, so aliases and column order
+# don't matter either. Numbers are compared with a relative tolerance.
+
+# numbers this close to zero are equal whatever rel_tol says
+ABS_TOL = 1e-9
+
+DEFAULT_DATA = os.path.join(
+    pathlib.Path(__file__).parent.parent.resolve(), "sales_data_insights", "data", "order_data.db"
+)
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def cells_equal(a, b, rel_tol: float) -> bool:
+    # ints and floats compare by value within rel_tol, everything else exactly
+    if is_number(a) and is_number(b):
+        if math.isnan(a) or math.isnan(b):
+            return math.isnan(a) and math.isnan(b)
+        return math.isclose(a, b, rel_tol=rel_tol, abs_tol=ABS_TOL)
+    return a == b
+
+
+def sort_key(row: tuple) -> tuple:
+    # rows mix None, numbers and text, order by type first so they always compare
+    return tuple(
+        (0, 0) if value is None else (1, value) if is_number(value) else (2, str(value))
+        for value in row
+    )
+
+
+def rows_equal(expected: list[tuple], actual: list[tuple], rel_tol: float) -> bool:
+    """
+    True when both hold the same rows in any order. Both are sorted and compared cell
+    by cell, so numbers only need to be close.
+    """
+    if len(expected) != len(actual):
+        return False
+    return all(
+        len(a) == len(b) and all(cells_equal(x, y, rel_tol) for x, y in zip(a, b))
+        for a, b in zip(sorted(expected, key=sort_key), sorted(actual, key=sort_key))
+    )
+
+
+def match_columns(expected: list[tuple], actual: list[tuple], rel_tol: float) -> list[int]:
+    """
+    For every expected column, the index of an actual column holding the same values
+    (in any order), or None. Each actual column is used at most once.
+    """
+    expected_columns = [[(value,) for value in column] for column in zip(*expected)] if expected else []
+    actual_columns = [[(value,) for value in column] for column in zip(*actual)] if actual else []
+    used = set()
+    mapping = []
+    for expected_column in expected_columns:
+        index = next(
+            (i for i, actual_column in enumerate(actual_columns)
+             if i not in used and rows_equal(expected_column, actual_column, rel_tol)),
+            None,
+        )
+        if index is not None:
+            used.add(index)
+        mapping.append(index)
+    return mapping
+
+
+def count_overlap(expected: list[tuple], actual: list[tuple], rel_tol: float) -> int:
+    # rows only need to be compared with the rows that have the same text cells
+    def text_cells(row):
+        return tuple(None if is_number(value) else value for value in row)
+
+    candidates = {}
+    for row in actual:
+        candidates.setdefault(text_cells(row), []).append(row)
+
+    overlap = 0
+    for row in expected:
+        bucket = candidates.get(text_cells(row), [])
+        for i, candidate in enumerate(bucket):
+            if all(cells_equal(x, y, rel_tol) for x, y in zip(row, candidate)):
+                overlap += 1
+                del bucket[i]
+                break
+    return overlap
+
+
+def compare_results(expected: list[tuple], actual: list[tuple], rel_tol: float = 1e-6) -> dict:
+    """
+    Compares two result sets. "match" means the same rows (in any order, with columns
+    in any order), "partial" that only some of the expected columns or rows are there,
+    "mismatch" that nothing lines up. Numbers are equal when within rel_tol.
+    """
+    if not expected and not actual:
+        return {"status": "match", "score": 1.0}
+
+    mapping = match_columns(expected, actual, rel_tol)
+    matched = [index for index in mapping if index is not None]
+    if matched and len(matched) == len(mapping):
+        # every expected column has a counterpart, now the rows have to line up too
+        projected = [tuple(row[index] for index in mapping) for row in actual]
+        if rows_equal(expected, projected, rel_tol):
+            width = len(actual[0]) if actual else 0
+            if width == len(mapping):
+                return {"status": "match", "score": 1.0}
+            return {"status": "partial", "score": 0.5, "reason": "extra columns"}
+
+    # same rows up to columns without a counterpart, e.g. a differently rounded average
+    overlap = count_overlap(expected, actual, rel_tol)
+    if matched or overlap:
+        reason = f"{len(matched)} of {len(mapping)} columns and {overlap} of {len(expected)} rows match"
+        return {"status": "partial", "score": 0.5, "reason": reason}
+    return {"status": "mismatch", "score": 0.0}
+
+
+# one read-only connection per worker process
+_connection = None
+
+
+def _init_worker(data: str) -> None:
+    global _connection
+    _connection = ReadOnlyConnectionPool(data).connect()
+
+
+def execute(connection: sqlite3.Connection, query: str, timeout: float) -> tuple[list[tuple], float]:
+    start = time.perf_counter()
+    with deadline(connection, timeout):
+        rows = connection.execute(query.strip().rstrip(";")).fetchall()
+    return rows, round((time.perf_counter() - start) * 1000, 3)
+
+
+def grade(connection: sqlite3.Connection, query: str, ground_truth: str, timeout: float = 10.0,
+          rel_tol: float = 1e-6) -> dict:
+    result = {"ground_truth_ms": None, "query_ms": None}
+    try:
+        expected, result["ground_truth_ms"] = execute(connection, ground_truth, timeout)
+    except Exception as e:
+        # a broken ground truth says nothing about the generated query
+        return {**result, "status": "invalid_ground_truth", "score": None, "error": f"{e}"}
+    if not query:
+        return {**result, "status": "missing", "score": 0.0}
+    try:
+        actual, result["query_ms"] = execute(connection, query, timeout)
+    except Exception as e:
+        return {**result, "status": "error", "score": 0.0, "error": f"{e}"}
+
+    return {
+        **result,
+        **compare_results(expected, actual, rel_tol),
+        "ground_truth_rows": len(expected),
+        "query_rows": len(actual),
+    }
+
+
+def _grade_in_worker(args: tuple) -> dict:
+    query, ground_truth, timeout, rel_tol = args
+    return grade(_connection, query, ground_truth, timeout, rel_tol)
+
+
+class SqlExecutionEvaluator:
+
+    """
+    promptflow evaluator that grades a generated query by running it and the ground
+    truth query against the database and comparing the results.
+    """
+
+    def __init__(self, data: str = None, timeout: float = 10.0, rel_tol: float = 1e-6):
+        self.data = data if data else DEFAULT_DATA
+        self.timeout = timeout
+        self.rel_tol = rel_tol
+        self.pool = ReadOnlyConnectionPool(self.data)
+
+    def __call__(self, *, query: str, ground_truth: str, **kwargs):
+        return grade(self.pool.connection(), query, ground_truth, self.timeout, self.rel_tol)
+
+
+def grade_rows(rows: list[dict], data: str = None, workers: int = None, timeout: float = 10.0,
+               rel_tol: float = 1e-6) -> list[dict]:
+    """
+    Grades (query, ground_truth_query) rows in a process pool, results in row order.
+    """
+    tasks = [(row.get("query"), row["ground_truth_query"], timeout, rel_tol) for row in rows]
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(data if data else DEFAULT_DATA,)
+    ) as executor:
+        return list(executor.map(_grade_in_worker, tasks, chunksize=max(1, len(tasks) // 32)))
+
+
+def summarize(results: list[dict]) -> dict:
+    graded = [result for result in results if result["score"] is not None]
+    statuses = Counter(result["status"] for result in results)
+    query_ms = [result["query_ms"] for result in results if result["query_ms"] is not None]
+    ground_truth_ms = [result["ground_truth_ms"] for result in results if result["ground_truth_ms"] is not None]
+
+    def p50(values):
+        return statistics.median(values) if values else None
+
+    return {
+        "rows": len(results),
+        **{status: statuses.get(status, 0) for status in ["match", "partial", "mismatch", "error", "missing", "invalid_ground_truth"]},
+        "accuracy": statuses.get("match", 0) / len(graded) if graded else None,
+        "score": sum(result["score"] for result in graded) / len(graded) if graded else None,
+        "query_ms_p50": p50(query_ms),
+        "query_ms_max": max(query_ms) if query_ms else None,
+        "ground_truth_ms_p50": p50(ground_truth_ms),
+    }
+
+
+def load_rows(path: str) -> list[dict]:
+    """
+    Reads a test set (.jsonl with ground_truth_query and optionally query) or the
+    response.json written by evaluate.py.
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            rows = json.load(f)["rows"]
+        return [
+            {"question": row.get("inputs.question"), "query": row.get("outputs.query"),
+             "ground_truth_query": row["inputs.ground_truth_query"]}
+            for row in rows
+        ]
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Test set .jsonl with query and ground_truth_query, or evaluate.py's response.json")
+    parser.add_argument("--db", help="SQLite database to run the queries on", default=DEFAULT_DATA)
+    parser.add_argument("--workers", help="Worker processes", type=int, default=None)
+    parser.add_argument("--timeout", help="Seconds per query", type=float, default=10.0)
+    parser.add_argument("--rel-tol", help="Relative tolerance for numbers", type=float, default=1e-6)
+    parser.add_argument("--fast-path", help="Fill in missing queries with the local fast path matcher", action="store_true")
+    parser.add_argument("--output", help="Write the per row results as jsonl to this file")
+    args = parser.parse_args()
+
+    rows = load_rows(args.path)
+    if args.fast_path:
+        from sales_data_insights.fastpath import FastPath
+        from sales_data_insights.prompt import PromptBuilder
+        prompt_builder = PromptBuilder(ReadOnlyConnectionPool(args.db).connect())
+        fast_path = FastPath(prompt_builder.hierarchy, prompt_builder.regions)
+        for row in rows:
+            if not row.get("query"):
+                row["query"] = fast_path.match(row["question"])
+
+    start = time.perf_counter()
+    results = grade_rows(rows, args.db, args.workers, args.timeout, args.rel_tol)
+    elapsed = time.perf_counter() - start
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for row, result in zip(rows, results):
+                f.write(json.dumps({**row, **result}) + "\n")
+
+    for row, result in zip(rows, results):
+        if result["status"] not in ("match", "missing"):
+            print(f"{result['status']:>20}  {row.get('question')}  {result.get('reason') or result.get('error') or ''}")
+    print(json.dumps({**summarize(results), "seconds": round(elapsed, 2)}, indent=2))
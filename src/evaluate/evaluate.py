@@ -8,6 +8,7 @@ from pprint import pprint
 from promptflow.client import load_flow
 from promptflow.evals.evaluate import evaluate
 from promptflow.evals.evaluators import ContentSafetyEvaluator
+from custom_evaluators.sql_execution import SqlExecutionEvaluator
 from sales_data_insights.main import SalesDataInsights
 
 load_dotenv(override=True)
@@ -20,7 +21,7 @@ def error_to_number(error: str):
     numerical_error = 0 if not error or error == "None" else 1
     return {"error": numerical_error}
 
-def main(model="azure_openai", data="small"):
+def main(model="azure_openai", data="small", judge=True):
     # which test set to use
     if data == "small":
         data_set = "test_set_small.jsonl"
@@ -40,6 +41,47 @@ def main(model="azure_openai", data="small"):
     sql_similarity_evaluator = load_flow(prompty_path)
     execution_time_evaluator = extract_execution_time
     error_evaluator = error_to_number
+    sql_execution_evaluator = SqlExecutionEvaluator()
+
+    evaluators = {
+        "execution_time": execution_time_evaluator,
+        "error": error_evaluator,
+        # runs the generated and the ground truth query and compares the results
+        "sql_execution": sql_execution_evaluator,
+    }
+    evaluator_config = {
+        "sql_execution": {
+            "query": "${target.query}",
+            "ground_truth": "${data.ground_truth_query}"
+        },
+        "execution_time": {
+            "execution_time": "${target.execution_time}"
+        },
+        "error": {
+            "error": "${target.error}"
+        },
+    }
+    if judge:
+        evaluators.update({
+            # Check out promptflow-evals package for more built-in evaluators
+            # like gpt-groundedness, gpt-similarity and content safety metrics.
+            "content_safety": ContentSafetyEvaluator(project_scope={
+                "subscription_id": "15ae9cb6-95c1-483d-a0e3-b1a1a3b06324",
+                "resource_group_name": "danielsc",
+                "project_name": "build-demo-project"
+            }),
+            "sql_similarity": sql_similarity_evaluator,
+        })
+        evaluator_config.update({
+            "sql_similarity": {
+                "response": "${target.query}",
+                "ground_truth": "${data.ground_truth_query}"
+            },
+            "content_safety": {
+                "question": "${target.query}",
+                "answer": "${target.data}"
+            }
+        })
 
     # Run evaluation
     with tempfile.TemporaryDirectory() as d: 
@@ -54,34 +96,8 @@ def main(model="azure_openai", data="small"):
             evaluation_name=evaluation_name,
             data=data_file,
             target=SalesDataInsights(model_type=model),
-            evaluators={ 
-            # Check out promptflow-evals package for more built-in evaluators
-            # like gpt-groundedness, gpt-similarity and content safety metrics.
-                "content_safety": ContentSafetyEvaluator(project_scope={
-                    "subscription_id": "15ae9cb6-95c1-483d-a0e3-b1a1a3b06324",
-                    "resource_group_name": "danielsc",
-                    "project_name": "build-demo-project"
-                }),
-                "execution_time": execution_time_evaluator,
-                "error": error_evaluator,
-                "sql_similarity": sql_similarity_evaluator,
-            },
-            evaluator_config={
-                "sql_similarity": {
-                    "response": "${target.query}",
-                    "ground_truth": "${data.ground_truth_query}"
-                },
-                "execution_time": {
-                    "execution_time": "${target.execution_time}"
-                },
-                "error": {
-                    "error": "${target.error}"
-                },
-                "content_safety": {
-                    "question": "${target.query}",
-                    "answer": "${target.data}"
-                }
-            }
+            evaluators=evaluators,
+            evaluator_config=evaluator_config
         )
 
     print("\n")
@@ -101,11 +117,12 @@ def main(model="azure_openai", data="small"):
 
 if __name__ == '__main__':
     # add argparse to load --model parameter which defaults to "azure_openai"
-    # valid values are: ["azure_openai", "phi3_mini", "phi3_medium", "cohere_chat", "mistral_small", "mistral_large", "llama3"]
+    # valid values are: ["azure_openai", "phi3_mini", "phi3_medium", "cohere_chat", "mistral_small", "mistral_large", "llama3", "replay"]
     # data parameter defaults to "small" and can be either "small", "large" or a path to a jsonl file
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model", help="Model to evaluate", default="azure_openai", choices=["azure_openai", "phi3_mini", "phi3_medium", "cohere_chat", "mistral_small", "mistral_large", "llama3"])
+    parser.add_argument("--model", help="Model to evaluate", default="azure_openai", choices=["azure_openai", "phi3_mini", "phi3_medium", "cohere_chat", "mistral_small", "mistral_large", "llama3", "replay"])
     parser.add_argument("--data", help="Data to evaluate. Can be either 'mini', 'small', 'large', or a file name.", default="small")
+    parser.add_argument("--no-judge", help="Skip the LLM judged evaluators (sql_similarity, content_safety)", action="store_true")
     args = parser.parse_args()
-    main(model=args.model, data=args.data)
\ No newline at end of file
+    main(model=args.model, data=args.data, judge=not args.no_judge)
\ No newline at end of file
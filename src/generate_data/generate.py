@@ -1,15 +1,22 @@
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 
-def generate_order_data(num_rows, boost):
+# the rollups come from the sales_data_insights package next to this directory, make it
+# importable when the script is run as `python generate_data/generate.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+def generate_order_data(rng, boost):
+    # boost can have any shape (e.g. region x day x category), one row is generated per element
+    shape = boost.shape
+
     # Generate 'Number_of_Orders' first to use as a base for constraints
-    number_of_orders = np.int32(np.random.randint(0, 10, num_rows) * boost/10)
+    number_of_orders = (rng.integers(0, 10, shape) * boost / 10).astype(np.int32)
     number_of_orders = np.maximum(number_of_orders, 1)
     # for the rows that have number_of_orders == 1, introduce a random chance to increase the number of orders
-    for i in range(num_rows):
-        if number_of_orders[i] == 1:
-            if np.random.random() < 0.1:
-                number_of_orders[i] = 2
+    number_of_orders[(number_of_orders == 1) & (rng.random(shape) < 0.1)] = 2
     # Define averages for scalability
     average_order_value = 30 * 1/boost  # Average order value per order
     items_per_order = 3.5     # Average number of items per order
@@ -19,18 +26,64 @@ def generate_order_data(num_rows, boost):
     # Generate other columns with normal distribution based on 'Number_of_Orders'
     data = {
         "Number_of_Orders": number_of_orders,
-        "Sum_of_Order_Value_USD": np.abs(np.random.normal(average_order_value, 5, num_rows)) * number_of_orders,
-        "Sum_of_Number_of_Items": np.abs(np.floor(np.random.normal(items_per_order, 3, num_rows))) * number_of_orders,
-        "Number_of_Orders_with_Discount": np.random.randint(0, number_of_orders + 1),
-        "Sum_of_Discount_Percentage": np.random.uniform(0.1, 1, num_rows) * 100,  # Constant range for percentage
-        "Sum_of_Shipping_Cost_USD": np.abs(np.random.normal(shipping_cost_per_order, 2, num_rows)) * number_of_orders,
-        "Number_of_Orders_Returned": np.random.randint(0, number_of_orders + 1),
-        "Number_of_Orders_Cancelled": np.random.randint(0, number_of_orders + 1),
-        "Sum_of_Time_to_Fulfillment": np.random.normal(time_per_order, 0.5, num_rows) * number_of_orders,
-        "Number_of_Orders_Repeat_Customers": np.random.randint(0, number_of_orders + 1)
+        "Sum_of_Order_Value_USD": np.abs(rng.normal(average_order_value, 5, shape)) * number_of_orders,
+        "Sum_of_Number_of_Items": np.abs(np.floor(rng.normal(items_per_order, 3, shape))) * number_of_orders,
+        "Number_of_Orders_with_Discount": rng.integers(0, number_of_orders + 1),
+        "Sum_of_Discount_Percentage": rng.uniform(0.1, 1, shape) * 100,  # Constant range for percentage
+        "Sum_of_Shipping_Cost_USD": np.abs(rng.normal(shipping_cost_per_order, 2, shape)) * number_of_orders,
+        "Number_of_Orders_Returned": rng.integers(0, number_of_orders + 1),
+        "Number_of_Orders_Cancelled": rng.integers(0, number_of_orders + 1),
+        "Sum_of_Time_to_Fulfillment": rng.normal(time_per_order, 0.5, shape) * number_of_orders,
+        "Number_of_Orders_Repeat_Customers": rng.integers(0, number_of_orders + 1)
     }
 
-    return pd.DataFrame(data)
+    return {column: values.ravel() for column, values in data.items()}
+
+def generate_chunks(product_categories, regions, start_date, end_date, rng, chunk_days=31):
+    # yields one DataFrame per block of days holding every region x day x category row
+    num_days = (end_date - start_date).days
+    num_regions = len(regions)
+    num_categories = len(product_categories)
+
+    for first_day in range(0, num_days, chunk_days):
+        day_index = np.arange(first_day, min(first_day + chunk_days, num_days))
+        order_days = start_date + pd.to_timedelta(day_index, unit="D")
+        region_index = np.arange(num_regions)
+
+        # broadcast the day and region boosts to region x day x category
+        boost1 = (10 + order_days.dayofweek.values + 10 * (day_index / num_days)) / 10
+        boost2 = (0.2 * np.sin(day_index / 90 * 2 * np.pi) + 1)
+        # regions beyond the tenth would get a non-positive boost, so the boost repeats
+        boost3 = (10 - region_index % 10) / 10
+        boost = boost3[:, None, None] * (boost1 * boost2)[None, :, None] * np.ones(num_categories)[None, None, :]
+
+        shape = boost.shape
+        order_data = pd.DataFrame(generate_order_data(rng, boost))
+        order_data['Year'] = np.broadcast_to(order_days.year.values[None, :, None], shape).ravel()
+        order_data['Month'] = np.broadcast_to(order_days.month.values[None, :, None], shape).ravel()
+        order_data['Day'] = np.broadcast_to(order_days.day.values[None, :, None], shape).ravel()
+        order_data['Date'] = np.broadcast_to(order_days.values[None, :, None], shape).ravel()
+        order_data['Day_of_Week'] = np.broadcast_to(order_days.dayofweek.values[None, :, None], shape).ravel()
+
+        # bring product categories and order data together
+        # in the end we will have a table with product categories and order data
+        for col in product_categories.columns:
+            order_data[col] = np.broadcast_to(product_categories[col].values[None, None, :], shape).ravel()
+        order_data['Region'] = np.broadcast_to(np.array(regions, dtype=object)[:, None, None], shape).ravel()
+
+        yield order_data
+
+def scale_product_categories(product_categories, scale):
+    # every product_type gets scale - 1 numbered copies for load test datasets
+    if scale <= 1:
+        return product_categories
+    copies = []
+    for copy in range(1, scale + 1):
+        categories = product_categories.copy()
+        if copy > 1:
+            categories['product_type'] = categories['product_type'] + f" #{copy}"
+        copies.append(categories)
+    return pd.concat(copies, ignore_index=True)
 
 def save_to_csv(df, filename="data/order_data.csv"):
     # Save the DataFrame to a CSV file
@@ -38,51 +91,75 @@ def save_to_csv(df, filename="data/order_data.csv"):
     print(f"Data saved to {filename}")
 
 def save_to_sql(df, filename="data/order_data.db"):
+    save_chunks_to_sql([df], filename)
+
+def save_chunks_to_sql(chunks, filename="data/order_data.db"):
     import sqlite3
-    conn = sqlite3.connect(filename)
-    df.to_sql("order_data", conn, if_exists="replace", index=False)
-    conn.close()
-    print(f"Data saved to {filename}")
+    from sales_data_insights.rollups import build_rollups
+    # build into a new file next to the target and swap it in when it's complete, so an
+    # interrupted run never leaves a half written database behind
+    building = f"{filename}.building"
+    if os.path.exists(building):
+        os.remove(building)
+    conn = sqlite3.connect(building)
+    try:
+        # the new file is thrown away if anything fails, so skip the rollback journal and fsyncs while loading
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        rows = 0
+        for i, df in enumerate(chunks):
+            df.to_sql("order_data", conn, if_exists="replace" if i == 0 else "append", index=False)
+            rows += len(df)
+        # index the dimensions and pre-aggregate the rollups SalesDataInsights queries against
+        build_rollups(conn)
+        conn.close()
+        # with synchronous off nothing is on disk yet, flush before the swap
+        with open(building, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(building, filename)
+    except BaseException:
+        conn.close()
+        if os.path.exists(building):
+            os.remove(building)
+        raise
+    print(f"Data saved to {filename} ({rows} rows)")
 
-# read in product categories
-import os
-current_dir = os.path.dirname(os.path.realpath(__file__))
-product_categories = pd.read_csv(f"{current_dir}/product_categories.csv")
-num_categories = len(product_categories)
-
-regions = ["North America", "Europe", "Asia-Pacific", "Africa", "Middle East", "South America"]
-regions = [region.upper() for region in regions]
-
-num_regions = len(regions)
-
-start_date = pd.to_datetime('2023-01-01')
-end_date = pd.to_datetime('2024-05-21')
-# end_date = pd.to_datetime('2023-01-03')
-num_days = (end_date - start_date).days
-total_data = pd.DataFrame()
-
-for region_index in range(num_regions):
-    # generate order data for each day
-    for i in range(num_days):
-        order_day = start_date + pd.DateOffset(days=i)
-        boost1 = (10 + order_day.dayofweek + 10 * (i/num_days)) / 10
-        boost2 = (0.2 * np.sin(i/90 * 2 * np.pi) + 1)
-        boost3 = (10-region_index) / 10
-        boost = boost1 * boost2 * boost3
-        #print(f"boost: {boost:.2f}, {boost1:.2f}, {boost2:.2f}, {boost3:.2f} on {order_day.dayofweek}, i={i}, region {regions[region_index]}")
-        order_data = generate_order_data(num_categories, boost)
-        order_data['Year'] = order_day.year
-        order_data['Month'] = order_day.month
-        order_data['Day'] = order_day.day
-        order_data['Date'] = order_day
-        order_data['Day_of_Week'] = order_day.dayofweek
-        
-        # bring product categories and order data together
-        # in the end we will have a table with product categories and order data
-        for col in product_categories.columns:
-            order_data[col] = product_categories[col]
-        order_data['Region'] = regions[region_index]
+if __name__ == "__main__":
+    import argparse
+    import time
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start-date", help="First day of orders", default="2023-01-01")
+    parser.add_argument("--end-date", help="Day after the last day of orders", default="2024-05-21")
+    parser.add_argument("--regions", help="Number of regions", type=int, default=6)
+    parser.add_argument("--scale", help="Number of copies of every product_type", type=int, default=1)
+    parser.add_argument("--seed", help="Random seed", type=int, default=None)
+    parser.add_argument("--chunk-days", help="Days generated and written per chunk", type=int, default=31)
+    parser.add_argument("--output", help="SQLite file to write",
+                        default=f"{current_dir}/../sales_data_insights/data/order_data.db")
+    args = parser.parse_args()
+
+    # read in product categories
+    product_categories = pd.read_csv(f"{current_dir}/product_categories.csv")
+    product_categories = scale_product_categories(product_categories, args.scale)
 
-        total_data = pd.concat([total_data, order_data], ignore_index=True)
+    regions = ["North America", "Europe", "Asia-Pacific", "Africa", "Middle East", "South America"]
+    regions = [region.upper() for region in regions]
+    regions = (regions + [f"REGION {i + 1}" for i in range(len(regions), args.regions)])[:args.regions]
 
-save_to_sql(total_data, filename=f"{current_dir}/../assistant_flow/sales_data_insights/data/order_data.db")
+    start = time.time()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_chunks_to_sql(
+        generate_chunks(
+            product_categories,
+            regions,
+            pd.to_datetime(args.start_date),
+            pd.to_datetime(args.end_date),
+            np.random.default_rng(args.seed),
+            chunk_days=args.chunk_days,
+        ),
+        filename=args.output,
+    )
+    print(f"Generated in {time.time() - start:.1f}s")
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_question(question: str) -> str:
+    # case, whitespace and trailing punctuation don't change the SQL we'd generate,
+    # operators, signs and other symbols inside the question do
+    question = " ".join(question.lower().split())
+    return question.rstrip("?!.,;: ")
+
+
+class SqlCache:
+
+    """
+    Question -> SQL cache with LRU and TTL eviction. Entries are kept in memory and,
+    when a path is given, in a SQLite file so they survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 24 * 3600, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sql_cache (key TEXT PRIMARY KEY, query TEXT, created REAL)"
+            )
+            self.db.execute("DELETE FROM sql_cache WHERE created < ?", (time.time() - self.ttl,))
+            self.db.commit()
+
+    @staticmethod
+    def key(question: str, model_type: str, system_prompt: str) -> str:
+        prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+        return hashlib.sha256(
+            f"{model_type}\0{prompt_hash}\0{normalize_question(question)}".encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> str:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute(
+                    "SELECT query, created FROM sql_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = row
+                    self.entries[key] = entry
+
+            if entry is not None and now - entry[1] > self.ttl:
+                self.entries.pop(key, None)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, query: str) -> None:
+        entry = (query, time.time())
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sql_cache (key, query, created) VALUES (?, ?, ?)",
+                    (key, *entry),
+                )
+                self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+def canonicalize_sql(query: str) -> str:
+    # lower case and collapse whitespace outside of quoted literals, values stay as they are
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", query.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else " ".join(part.lower().split()) for i, part in enumerate(parts)
+    )
+
+
+# SQL whose result changes without the database changing, 'now' and the CURRENT_*
+# keywords follow the clock, random() is different on every run
+VOLATILE_SQL = re.compile(
+    r"""['"]now['"]|\bcurrent_(?:date|time|timestamp)\b|\brandom(?:blob)?\s*\("""
+    r"""|\b(?:date|time|datetime|julianday|unixepoch)\s*\(\s*\)""",
+    re.IGNORECASE,
+)
+
+
+def is_volatile(query: str) -> bool:
+    return VOLATILE_SQL.search(query) is not None
+
+
+class ResultCache:
+
+    """
+    SQL -> result cache bounded by the total size of the cached results. All entries
+    are dropped as soon as the database changes. Volatile queries (see VOLATILE_SQL)
+    are never cached.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    def validate(self, version, changed: bool = False) -> None:
+        with self.lock:
+            if changed or version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, query: str):
+        if is_volatile(query):
+            return None
+        key = canonicalize_sql(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, query: str, result, version) -> None:
+        if is_volatile(query):
+            return
+        size = len(json.dumps(result, default=str))
+        if size > self.max_bytes:
+            return
+
+        key = canonicalize_sql(query)
+        with self.lock:
+            # the database changed while the query was running
+            if version != self.version:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+_sql_cache = None
+_sql_cache_lock = threading.Lock()
+
+
+def get_sql_cache() -> SqlCache:
+    """
+    Returns the process-wide SQL cache, configured from SQL_CACHE_SIZE,
+    SQL_CACHE_TTL and SQL_CACHE_PATH.
+    """
+    global _sql_cache
+    with _sql_cache_lock:
+        if _sql_cache is None:
+            _sql_cache = SqlCache(
+                max_entries=int(os.getenv("SQL_CACHE_SIZE", "1024")),
+                ttl=float(os.getenv("SQL_CACHE_TTL", str(24 * 3600))),
+                path=os.getenv("SQL_CACHE_PATH"),
+            )
+        return _sql_cache
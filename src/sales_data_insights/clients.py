@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import os
+import random
+import threading
+from typing import TYPE_CHECKING
+
+import httpx
+from openai import AsyncAzureOpenAI, AzureOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient
+
+if TYPE_CHECKING:
+    from azure.core.pipeline.transport import RequestsTransport
+
+# Process wide registry of model clients. The clients are thread safe, so the chat
+# flow, the assistant worker threads and the SalesDataInsights tool all share them
+# and reuse the keep-alive connections instead of doing a TLS handshake per call.
+
+_lock = threading.Lock()
+_clients = {}
+_http_client = None
+_async_http_client = None
+_transport = None
+
+
+def pool_size() -> int:
+    return int(os.getenv("CLIENT_POOL_SIZE", "20"))
+
+
+def get_http_client() -> httpx.Client:
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            size = pool_size()
+            _http_client = DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+            )
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            size = pool_size()
+            _async_http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+            )
+        return _async_http_client
+
+
+def get_transport() -> RequestsTransport:
+    global _transport
+    with _lock:
+        if _transport is None:
+            # requests and azure.core are only needed for the azure.ai.inference models
+            import requests
+            from azure.core.pipeline.transport import RequestsTransport
+
+            size = pool_size()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _transport = RequestsTransport(session=session, session_owner=False)
+        return _transport
+
+
+def get_client(model_type: str = "azure_openai", max_retries: int = None):
+    """
+    Returns the shared client for the model type, creating it on first use.
+    Clients are keyed by endpoint, model_type, api version and max_retries. With
+    max_retries set, it replaces the SDK's own retry count; callers that retry
+    themselves pass 0 so a rate limited call isn't retried twice over.
+    """
+    if model_type == "azure_openai":
+        endpoint = os.getenv("OPENAI_API_BASE")
+        api_version = os.getenv("OPENAI_API_VERSION")
+    elif model_type == "replay":
+        # recorded completions instead of a model, see replay.py
+        endpoint = os.getenv("REPLAY_RECORDINGS")
+        api_version = os.getenv("REPLAY_LATENCY")
+    else:
+        endpoint = os.getenv(f"AZUREAI_{model_type.upper()}_URL")
+        api_version = None
+
+    key = (endpoint, model_type, api_version, max_retries)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    if model_type == "azure_openai":
+        http_client = get_http_client()
+    elif model_type != "replay":
+        transport = get_transport()
+
+    with _lock:
+        # another thread might have created it while we were waiting for the lock
+        if key not in _clients:
+            if model_type == "azure_openai":
+                retries = {} if max_retries is None else {"max_retries": max_retries}
+                _clients[key] = AzureOpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    azure_endpoint=endpoint,
+                    api_version=api_version,
+                    http_client=http_client,
+                    **retries,
+                )
+            elif model_type == "replay":
+                from .replay import ReplayClient
+
+                _clients[key] = ReplayClient.from_env(endpoint)
+            else:
+                from azure.ai.inference import ChatCompletionsClient
+                from azure.core.credentials import AzureKeyCredential
+
+                # azure.core's RetryPolicy takes retry_total
+                retries = {} if max_retries is None else {"retry_total": max_retries}
+                _clients[key] = ChatCompletionsClient(
+                    endpoint=endpoint,
+                    credential=AzureKeyCredential(os.getenv(f"AZUREAI_{model_type.upper()}_KEY")),
+                    transport=transport,
+                    **retries,
+                )
+        return _clients[key]
+
+
+def get_async_client() -> AsyncAzureOpenAI:
+    """
+    Returns the shared AsyncAzureOpenAI client for the async chat path. Its connection
+    pool belongs to the event loop it is first used on, one per process with chainlit.
+    """
+    endpoint = os.getenv("OPENAI_API_BASE")
+    api_version = os.getenv("OPENAI_API_VERSION")
+
+    key = (endpoint, "azure_openai_async", api_version)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    http_client = get_async_http_client()
+    with _lock:
+        if key not in _clients:
+            _clients[key] = AsyncAzureOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                azure_endpoint=endpoint,
+                api_version=api_version,
+                http_client=http_client,
+            )
+        return _clients[key]
+
+
+def close_clients() -> None:
+    global _http_client, _async_http_client, _transport
+    with _lock:
+        _clients.clear()
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+        # an AsyncClient can only be closed from its event loop, the connections go with the process
+        _async_http_client = None
+        if _transport is not None:
+            _transport.session.close()
+            _transport = None
+
+
+def is_rate_limited(e: Exception) -> bool:
+    # openai errors carry status_code, azure.core HttpResponseError has it on the response
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+    return status_code == 429
+
+
+def retry_after(e: Exception) -> float | None:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # retry-after can also be an HTTP date, then we just use our own backoff
+        pass
+    return None
+
+
+def backoff_delay(e: Exception, attempt: int, base: float = 0.5, max_delay: float = 30.0) -> float:
+    """
+    Seconds to wait before retry number attempt + 1: exponential backoff with full
+    jitter so concurrent callers don't retry in lockstep, but never less than the
+    server's retry-after.
+    """
+    delay = random.uniform(0, min(max_delay, base * 2 ** attempt))
+    return max(delay, retry_after(e) or 0)
@@ -0,0 +1,99 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import weakref
+
+
+class _ThreadConnection:
+    # lives in the thread local, it's collected when its thread exits
+    def __init__(self, connection: sqlite3.Connection, file_id: tuple):
+        self.connection = connection
+        self.file_id = file_id
+        self.data_version = None
+
+
+def _close_connections(connections: set, connection: sqlite3.Connection = None) -> None:
+    # runs from finalizers, possibly in the middle of another pool call on the same thread,
+    # so no locks here; single set operations are atomic and closing twice is harmless
+    if connection is not None:
+        connections.discard(connection)
+        connection.close()
+        return
+    while connections:
+        try:
+            connections.pop().close()
+        except KeyError:
+            break
+
+
+class ReadOnlyConnectionPool:
+
+    """
+    Per-thread pool of read-only SQLite connections. Every thread gets its own
+    connection on first use and keeps it, so repeated queries hit a warm page cache
+    instead of reopening the database file. A connection is closed when its thread
+    exits, the remaining ones by close() or at interpreter exit.
+    """
+
+    def __init__(self, path: str, cache_size_kib: int = 65536, mmap_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.connections = set()
+        # closes what's left when the pool is collected or the interpreter exits
+        weakref.finalize(self, _close_connections, self.connections)
+
+    def connect(self) -> sqlite3.Connection:
+        uri = pathlib.Path(self.path).resolve().as_uri() + "?mode=ro"
+        # each connection is used by one thread only, but close() runs on another one
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.execute("PRAGMA query_only = ON")
+        # negative cache_size is in KiB rather than pages
+        connection.execute(f"PRAGMA cache_size = -{self.cache_size_kib}")
+        connection.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        return self.thread_connection().connection
+
+    def file_id(self) -> tuple:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def thread_connection(self) -> _ThreadConnection:
+        holder = getattr(self.local, "holder", None)
+        file_id = self.file_id()
+        if holder is not None and holder.file_id != file_id:
+            # the database file was replaced (generate.py swaps in a new one), an open
+            # connection would keep reading the old file
+            _close_connections(self.connections, holder.connection)
+            holder = None
+        if holder is None:
+            connection = self.connect()
+            holder = _ThreadConnection(connection, file_id)
+            self.connections.add(connection)
+            # short-lived worker threads would otherwise leave their connections open
+            weakref.finalize(holder, _close_connections, self.connections, connection)
+            self.local.holder = holder
+        return holder
+
+    def data_changed(self) -> bool:
+        """
+        True when another connection committed to the database since the last call
+        from this thread, based on PRAGMA data_version.
+        """
+        holder = self.thread_connection()
+        data_version = holder.connection.execute("PRAGMA data_version").fetchone()[0]
+        last_data_version = holder.data_version if holder.data_version is not None else data_version
+        holder.data_version = data_version
+        return data_version != last_data_version
+
+    def close(self) -> None:
+        # replace the thread local so no thread picks up a closed connection
+        self.local = threading.local()
+        _close_connections(self.connections)
@@ -0,0 +1,232 @@
+import re
+
+# Deterministic NL -> SQL for the question templates that come up all the time: listing
+# distinct values, totals and ratios filtered by time, region and category and grouped
+# by a few dimensions. A question is only answered when every word in it is accounted
+# for, anything else goes to the model.
+
+MONTHS = [
+    "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+]
+
+DIMENSIONS = {
+    "day of week": "Day_of_Week",
+    "weekday": "Day_of_Week",
+    "day": "Day",
+    "month": "Month",
+    "year": "Year",
+    "region": "Region",
+    "main category": "main_category",
+    "category": "main_category",
+    "sub category": "sub_category",
+    "product type": "product_type",
+}
+
+# phrase -> select expression, longer phrases come first so they win over their suffixes
+METRICS = {
+    "average order value": "SUM(Sum_of_Order_Value_USD) / SUM(Number_of_Orders) AS Avg_Order_Value",
+    "average sale value": "SUM(Sum_of_Order_Value_USD) / SUM(Number_of_Orders) AS Avg_Order_Value",
+    "average shipping cost": "SUM(Sum_of_Shipping_Cost_USD) / SUM(Number_of_Orders) AS Avg_Shipping_Cost",
+    "return rate": "SUM(Number_of_Orders_Returned) * 1.0 / SUM(Number_of_Orders) AS Return_Rate",
+    "cancellation rate": "SUM(Number_of_Orders_Cancelled) * 1.0 / SUM(Number_of_Orders) AS Cancellation_Rate",
+    "discount rate": "SUM(Number_of_Orders_with_Discount) * 1.0 / SUM(Number_of_Orders) AS Discount_Rate",
+    "repeat customer rate": "SUM(Number_of_Orders_Repeat_Customers) * 1.0 / SUM(Number_of_Orders) AS Repeat_Customer_Rate",
+    "sales revenue": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "revenue": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "value of orders": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "value of sales": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "order value": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "sales value": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "value": "SUM(Sum_of_Order_Value_USD) AS Total_Revenue",
+    "shipping cost": "SUM(Sum_of_Shipping_Cost_USD) AS Total_Shipping_Cost",
+    "number of items": "SUM(Sum_of_Number_of_Items) AS Total_Items",
+    "items": "SUM(Sum_of_Number_of_Items) AS Total_Items",
+    "returned orders": "SUM(Number_of_Orders_Returned) AS Total_Returned",
+    "returns": "SUM(Number_of_Orders_Returned) AS Total_Returned",
+    "cancelled orders": "SUM(Number_of_Orders_Cancelled) AS Total_Cancelled",
+    "number of orders": "SUM(Number_of_Orders) AS Total_Orders",
+    "how many orders": "SUM(Number_of_Orders) AS Total_Orders",
+    "orders": "SUM(Number_of_Orders) AS Total_Orders",
+}
+
+# words that carry no meaning once the literals, metric and dimensions are taken out
+FILLER = {
+    "a", "all", "and", "are", "by", "did", "distinct", "for", "from", "give", "grouped", "have",
+    "in", "is", "me", "of", "our", "over", "per", "processed", "query", "sold", "show", "the",
+    "total", "we", "were", "was", "what", "where", "made", "list", "sum",
+    "with", "=", "how", "many", "much", "during", "on", "to", "get",
+}
+
+COLUMN_WORDS = {
+    "main category": "main_category",
+    "sub category": "sub_category",
+    "product type": "product_type",
+    "region": "Region",
+}
+
+
+class FastPath:
+
+    """
+    Matches questions against the templates above, resolving category and region
+    literals against the known values. match() returns SQL or None when it's not
+    confident, in which case the model has to write the query.
+    """
+
+    def __init__(self, hierarchy: dict, regions: list[str]):
+        # phrase -> list of (column, value, parents) it could refer to
+        self.literals = {}
+
+        def add(column, value, parents):
+            if value == "OTHER":
+                return
+            self.literals.setdefault(value.lower(), []).append((column, value, parents))
+
+        for region in regions:
+            add("Region", region, {})
+        for main_category, sub_categories in hierarchy.items():
+            add("main_category", main_category, {})
+            for sub_category, product_types in sub_categories.items():
+                add("sub_category", sub_category, {"main_category": main_category})
+                for product_type in product_types:
+                    add("product_type", product_type, {"main_category": main_category, "sub_category": sub_category})
+
+        self.phrases = sorted(self.literals, key=len, reverse=True)
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        q = question.lower().replace("_", " ").replace('"', "'")
+        # drop quotes around literals but keep apostrophes like in "men's"
+        q = re.sub(r"(?<![a-z])'|'(?![a-z])", " ", q)
+        q = re.sub(r"[?!.,;:()]", " ", q)
+        return " ".join(q.split())
+
+    def match(self, question: str) -> str | None:
+        q = " " + self.normalize(question) + " "
+        filters = {}
+
+        # 1. category and region literals, each replaced by a placeholder
+        found = []
+        for phrase in self.phrases:
+            pattern = rf"(?<=\s){re.escape(phrase)}(?=\s)"
+            if re.search(pattern, q):
+                found.append(phrase)
+                q = re.sub(pattern, f"@{len(found) - 1}", q)
+
+        literal_columns = []
+        for phrase in found:
+            candidates = self.literals[phrase]
+            columns = {column for column, _, _ in candidates}
+            if len(columns) > 1:
+                return None
+            column = columns.pop()
+            literal_columns.append(column)
+            filters.setdefault(column, []).append(candidates[0][1])
+            # parents are only implied when the value has exactly one place in the tree
+            if len(candidates) == 1:
+                for parent_column, parent in candidates[0][2].items():
+                    filters.setdefault(parent_column, [])
+                    if parent not in filters[parent_column]:
+                        filters[parent_column].append(parent)
+
+        # "product type = @0" names the column of the literal, it has to agree
+        def column_for_literal(m):
+            if COLUMN_WORDS[m.group(1)] != literal_columns[int(m.group(2))]:
+                raise ValueError(m.group(0))
+            return f"@{m.group(2)}"
+
+        try:
+            q = re.sub(
+                rf"({'|'.join(COLUMN_WORDS)})\s*(?:=|of|like)?\s*@(\d+)", column_for_literal, q
+            )
+        except ValueError:
+            return None
+        q = re.sub(r"@\d+", " ", q)
+
+        # 2. time filters
+        conditions = []
+        m = re.search(r"\b(this|current) month\b", q)
+        if m:
+            conditions += ["Month = strftime('%m', 'now')", "Year = strftime('%Y', 'now')"]
+            q = q[:m.start()] + q[m.end():]
+        m = re.search(rf"\b({'|'.join(MONTHS)})\s+(20\d\d)\b", q) or re.search(
+            rf"\b(?:in|for)\s+({'|'.join(MONTHS)})\b()", q
+        )
+        if m:
+            conditions.append(f"Month = {MONTHS.index(m.group(1)) + 1}")
+            if m.group(2):
+                conditions.append(f"Year = {m.group(2)}")
+            q = q[:m.start()] + " in " + q[m.end():]
+        m = re.search(r"\bq([1-4])(?:\s+(20\d\d))?\b", q)
+        if m:
+            quarter = int(m.group(1))
+            months = ", ".join(str(month) for month in range(quarter * 3 - 2, quarter * 3 + 1))
+            conditions.append(f"Month IN ({months})")
+            if m.group(2):
+                conditions.append(f"Year = {m.group(2)}")
+            q = q[:m.start()] + q[m.end():]
+        m = re.search(r"\b(20\d\d)\b", q)
+        if m:
+            conditions.append(f"Year = {m.group(1)}")
+            q = q[:m.start()] + q[m.end():]
+        if re.search(r"\b(20\d\d|q[1-4]|this|current)\b", q):
+            return None
+
+        # 3. group by dimensions
+        dimension = "|".join(DIMENSIONS)
+        group_by = []
+        m = re.search(rf"\bby ((?:{dimension})(?:\s*(?:and|,)?\s*(?:{dimension})\b)*)", q)
+        if m:
+            group_by = [DIMENSIONS[d] for d in re.findall(rf"\b(?:{dimension})\b", m.group(1))]
+            q = q[:m.start()] + q[m.end():]
+        # Day is the day of the month, it only names one day when the month and year are
+        # fixed or grouped by too, otherwise group by the full date
+        if "Day" in group_by:
+            def fixed(column):
+                return column in group_by or any(c.startswith(f"{column} = ") for c in conditions)
+            if not (fixed("Month") and fixed("Year")):
+                group_by = ["Date" if column == "Day" else column for column in group_by]
+
+        # 4. DISTINCT listings or one metric
+        select = None
+        m = re.search(rf"\b(?:distinct )?values for (?:the )?((?:{dimension})(?:\s*(?:and|,)?\s*(?:{dimension})\b)*)", q)
+        if m:
+            if group_by:
+                return None
+            columns = [DIMENSIONS[d] for d in re.findall(rf"\b(?:{dimension})\b", m.group(1))]
+            q = q[:m.start()] + q[m.end():]
+            select = "DISTINCT " + ", ".join(dict.fromkeys(columns))
+        else:
+            for phrase, expression in METRICS.items():
+                pattern = rf"\b{phrase}\b"
+                if re.search(pattern, q):
+                    select = expression
+                    q = re.sub(pattern, " ", q)
+                    break
+            if select is None:
+                return None
+
+        # 5. only confident when nothing is left over
+        if set(q.split()) - FILLER:
+            return None
+
+        for column, values in filters.items():
+            if len(values) == 1:
+                conditions.insert(0, f'{column} = "{values[0]}"')
+            else:
+                conditions.insert(0, f'{column} IN ({", ".join(f"{chr(34)}{value}{chr(34)}" for value in values)})')
+        # keep the hierarchy order main -> sub -> product like the examples in the prompt
+        order = ["main_category", "sub_category", "product_type", "Region"]
+        conditions.sort(key=lambda c: order.index(c.split()[0]) if c.split()[0] in order else len(order))
+
+        group_by = list(dict.fromkeys(group_by))
+        if select.startswith("DISTINCT"):
+            query = f"SELECT {select} FROM order_data"
+        else:
+            query = f"SELECT {', '.join(group_by + [select])} FROM order_data"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if group_by:
+            query += " GROUP BY " + ", ".join(group_by)
+        return query
@@ -1,21 +1,31 @@
+import base64
 import os
 import pathlib
-import sqlite3
-from openai import AzureOpenAI
-import pandas as pd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from promptflow.tracing import trace
+from opentelemetry import context as otel_context
+from opentelemetry import trace as otel_trace
 import json
-from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import SystemMessage, UserMessage
-from azure.core.credentials import AzureKeyCredential
+from .cache import ResultCache, SqlCache, get_sql_cache
+from .clients import backoff_delay, get_client, is_rate_limited
+from .db import ReadOnlyConnectionPool
+from .fastpath import FastPath
+from .prompt import PromptBuilder
+from .results import encode_cursor
+from .rollups import available_rollups, rewrite_for_rollup
+from .watchdog import QueryError, check_plan, deadline
 from .system_message import system_message, system_message_short
 
 from typing import TypedDict
-class Result(TypedDict):
+class Result(TypedDict, total=False):
     data: dict
     error: str
     query: str
     execution_time: float
+    error_details: dict
+    attempts: int
 
 # Callable class with @trace decorator on the __call__ method
 class SalesDataInsights:
@@ -26,38 +36,189 @@ class SalesDataInsights:
     full end-to-end assistant experience.
     """
 
-    def __init__(self, data=None, model_type="azure_openai"):
+    def __init__(self, data=None, model_type="azure_openai", sql_cache=None,
+                 max_rows=1000, max_result_bytes=64 * 1024, summary=False,
+                 paged=False, page_size=200, query_timeout=10.0, compact_prompt=True,
+                 fast_path=True, max_retries=4, batch_concurrency=8):
         self.data = data if data else os.path.join(
             pathlib.Path(__file__).parent.resolve(), "data", "order_data.db"
         )
         self.model_type = model_type
+        # results are capped so a wide or unfiltered query can't blow up the tool output
+        self.max_rows = max_rows
+        self.max_result_bytes = max_result_bytes
+        self.summary = summary
+        # in paged mode results come back page by page, see next_page()
+        self.paged = paged
+        self.page_size = page_size
+        # generated queries running longer than this are interrupted
+        self.query_timeout = query_timeout
+        # build a compact prompt from the live database instead of the static system_message
+        self.compact_prompt = compact_prompt
+        self._prompt_builder = None
+        self.prompt_builder_version = None
+        # answer common question templates locally and only ask the model for the rest
+        self.fast_path = fast_path
+        self._fast_path = None
+        # rate limited model calls are retried with jittered exponential backoff
+        self.max_retries = max_retries
+        # how many questions of a batch() are in flight at once
+        self.batch_concurrency = batch_concurrency
+        self._executor = None
+        # connections are opened per thread on first use and closed when the thread exits
+        self.pool = ReadOnlyConnectionPool(self.data)
+        self.sql_cache = sql_cache if sql_cache else get_sql_cache()
+        self.rollups = []
+        self.rollups_version = None
+        self.result_cache = ResultCache(
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        )
+        # guards the lazily built state shared by the threads answering questions
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        self.pool.close()
 
     @trace
     def __call__(self, *, question: str, **kwargs) -> Result:
 
-        if self.model_type == "azure_openai":
-            client = AzureOpenAI(
-                                api_key = os.getenv("OPENAI_API_KEY"),
-                                azure_endpoint = os.getenv("OPENAI_API_BASE"),
-                                api_version = os.getenv("OPENAI_API_VERSION")
-                            )
-        else:
-            endpoint = os.getenv(f"AZUREAI_{self.model_type.upper()}_URL")
-            key = os.getenv(f"AZUREAI_{self.model_type.upper()}_KEY")
-            print("endpoint", endpoint)
-            print("key", key)
-            client = ChatCompletionsClient(
-                endpoint=endpoint,
-                credential=AzureKeyCredential(key),
-            )
         # Code to get time to execute the function
-        import time
         start = time.time()
         
         print("getting sales data insights")
         print("question", question)
 
-        if self.model_type == "azure_openai":
+        # identical questions compile to identical SQL, skip the model when we've seen it
+        cache_key = SqlCache.key(question, self.model_type, self.system_prompt(question))
+        query = self.sql_cache.get(cache_key)
+
+        span = otel_trace.get_current_span()
+        span.set_attribute("sql_cache_hit", query is not None)
+        span.set_attribute("sql_cache_hits", self.sql_cache.hits)
+        span.set_attribute("sql_cache_misses", self.sql_cache.misses)
+
+        cache_hit = query is not None
+        fast_path_hit = False
+        if not cache_hit and self.fast_path:
+            query = self.fast_path_matcher().match(question)
+            fast_path_hit = query is not None
+        span.set_attribute("fast_path_hit", fast_path_hit)
+        attempts = 0
+        if query is None:
+            query, attempts = self.generate_query_with_retry(question)
+        span.set_attribute("generate_attempts", attempts)
+
+        try:
+            data = self.query_db(query)
+        except Exception as e:
+            end = time.time()
+            execution_time = round(end - start, 2)
+            print("Execution time:", execution_time)
+            return self.error_result(e, query, execution_time)
+
+        # only model generated queries that ran successfully are worth reusing
+        if not cache_hit and not fast_path_hit:
+            self.sql_cache.put(cache_key, query)
+
+        end = time.time()
+        execution_time = round(end - start, 2)
+
+        return {"data": data, "error": str(None), "query": query, "execution_time": execution_time,
+                "attempts": attempts}
+
+    @trace
+    def batch(self, questions: list[str], **kwargs) -> list[Result]:
+        """
+        Answers many independent questions concurrently, at most batch_concurrency at
+        a time across all batches of this instance. Results come back in the order of
+        the questions, each with its own execution_time. A question that fails doesn't
+        fail the batch, it gets an error result instead.
+        """
+        # every question is traced as a child of the batch span
+        current_context = otel_context.get_current()
+
+        def answer(question):
+            token = otel_context.attach(current_context)
+            start = time.time()
+            try:
+                return self(question=question)
+            except Exception as e:
+                return self.error_result(e, None, round(time.time() - start, 2))
+            finally:
+                otel_context.detach(token)
+
+        return list(self.executor().map(answer, questions))
+
+    def executor(self) -> ThreadPoolExecutor:
+        # the workers share the model clients and get their connections from self.pool;
+        # they live as long as the instance, so their connections are reused across batches
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, self.batch_concurrency),
+                    thread_name_prefix="sales_data_insights",
+                )
+            return self._executor
+
+    @staticmethod
+    def error_result(e: Exception, query: str, execution_time: float) -> Result:
+        result = {"data": None, "error": f"{e}", "query": query, "execution_time": execution_time}
+        # timeouts and rejected plans also say what happened in a machine readable way
+        if isinstance(e, QueryError):
+            result["error_details"] = e.to_dict()
+        return result
+
+    def system_prompt(self, question: str) -> str:
+        if self.compact_prompt:
+            return self.prompt_builder().build(question)
+        if self.model_type.lower() == "phi3_mini":
+            return system_message_short
+        return system_message
+
+    def prompt_builder(self) -> PromptBuilder:
+        # the schema and category tree come from the database, rebuild them when it changes
+        version = self.database_version()
+        if self.prompt_builder_version != version:
+            with self.lock:
+                # another thread may have built it while we were waiting
+                if self.prompt_builder_version != version:
+                    self._prompt_builder = PromptBuilder(self.pool.connection())
+                    self._fast_path = None
+                    self.prompt_builder_version = version
+        return self._prompt_builder
+
+    def fast_path_matcher(self) -> FastPath:
+        # the known categories and regions come from the same rebuild as the prompt
+        prompt_builder = self.prompt_builder()
+        if self._fast_path is None:
+            with self.lock:
+                if self._fast_path is None:
+                    self._fast_path = FastPath(prompt_builder.hierarchy, prompt_builder.regions)
+        return self._fast_path
+
+    def generate_query_with_retry(self, question: str) -> tuple[str, int]:
+        """Returns the generated query and the number of model calls it took."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.generate_query(question), attempt + 1
+            except Exception as e:
+                if attempt == self.max_retries or not is_rate_limited(e):
+                    raise
+                delay = backoff_delay(e, attempt)
+                print(f"Rate limited, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def generate_query(self, question: str) -> str:
+        # generate_query_with_retry does the retrying, the SDK's retries are turned off
+        client = get_client(self.model_type, max_retries=0)
+        system_message = self.system_prompt(question)
+
+        # the replay client serves recorded azure_openai style completions
+        if self.model_type in ("azure_openai", "replay"):
             messages = [{"role": "system", "content": system_message}]
         
             messages.append({"role": "user", "content": f"{question}\nGive only the query in SQL format"})
@@ -67,14 +228,18 @@ class SalesDataInsights:
                 messages=messages, 
             )
         elif self.model_type.lower() == "phi3_mini":
-            combined_message = UserMessage(content=f"{system_message_short}\n\n{question}\nGive only the query in SQL format")
+            # azure.ai.inference is only imported once a model other than azure_openai is used
+            from azure.ai.inference.models import UserMessage
+            combined_message = UserMessage(content=f"{system_message}\n\n{question}\nGive only the query in SQL format")
             messages = [combined_message]
             response = client.create(messages=messages, temperature=0, max_tokens=1000)
         elif self.model_type.lower() == "phi3_medium":
+            from azure.ai.inference.models import UserMessage
             combined_message = UserMessage(content=f"{system_message}\n\n{question}\nGive only the query in SQL format")
             messages = [combined_message]
             response = client.create(messages=messages, temperature=0, max_tokens=1000)
         else:
+            from azure.ai.inference.models import SystemMessage, UserMessage
             system_message_obj = SystemMessage(content=system_message)
             user_message_obj = UserMessage(content=f"{question}\nGive only the query in SQL format")
             messages = [system_message_obj, user_message_obj]
@@ -87,26 +252,84 @@ class SalesDataInsights:
         if query.startswith("```sql") and query.endswith("```"):
             query = query[6:-3].strip()
 
+        return query
+    
+    def database_version(self):
+        stat = os.stat(self.data)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @trace
+    def next_page(self, *, page_token: str, **kwargs) -> Result:
+        """
+        Follow-up tool entry point, returns the page of a paged result that
+        page_token (the next_page_token of the previous page) points to.
+        """
+        start = time.time()
         try:
-            data = self.query_db(query)
+            page = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+            query, offset = page["query"], int(page["offset"])
         except Exception as e:
-            end = time.time()
-            execution_time = round(end - start, 2)
-            print("Execution time:", execution_time)
-            return {"data": None, "error": f"{e}", "query": query, "execution_time": execution_time}
+            return {"data": None, "error": f"Invalid page_token: {e}", "query": None, "execution_time": 0.0}
 
-        end = time.time()
-        execution_time = round(end - start, 2)
+        try:
+            data = self.query_db(query, offset=offset)
+        except Exception as e:
+            return self.error_result(e, query, round(time.time() - start, 2))
+
+        return {"data": data, "error": str(None), "query": query, "execution_time": round(time.time() - start, 2)}
+
+    @staticmethod
+    def page_token(query: str, offset: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps({"query": query, "offset": offset}).encode()).decode()
 
-        return {"data": data, "error": str(None), "query": query, "execution_time": execution_time}
-    
     @trace
-    def query_db(self, query: str) -> dict:
-        sql_connection = sqlite3.connect(self.data)
+    def query_db(self, query: str, offset: int = 0) -> dict:
+        query = query.strip().rstrip(";")
+
+        # later pages skip the rows that were already returned
+        def at_offset(query):
+            if not offset:
+                return query
+            return f"SELECT * FROM ({query}) LIMIT -1 OFFSET {offset}"
+
+        # cached results are dropped when order_data.db is rewritten, queries on 'now' aren't cached
+        version = self.database_version()
+        self.result_cache.validate(version, changed=self.pool.data_changed())
+
+        data = self.result_cache.get(at_offset(query))
+        otel_trace.get_current_span().set_attribute("result_cache_hit", data is not None)
+        if data is not None:
+            return data
+
+        sql_connection = self.pool.connection()
+
+        # aggregates that a rollup table answers exactly don't need to scan order_data
+        if self.rollups_version != version:
+            self.rollups = available_rollups(sql_connection)
+            self.rollups_version = version
+        rollup_query, rollup = rewrite_for_rollup(query, self.rollups)
+        otel_trace.get_current_span().set_attribute("rollup_table", str(rollup))
+
+        # generated SQL is untrusted, refuse cartesian plans and bound the run time
+        check_plan(sql_connection, at_offset(rollup_query))
 
-        df = pd.read_sql(query, sql_connection)
+        with deadline(sql_connection, self.query_timeout):
+            # read straight off the cursor into the compact columnar format
+            cursor = sql_connection.execute(at_offset(rollup_query))
+            try:
+                if self.paged:
+                    # only one page is ever fetched, however many rows the query produces
+                    data = encode_cursor(cursor, self.page_size, self.max_result_bytes)
+                    if data["truncated"]:
+                        data["next_page_token"] = self.page_token(query, offset + data["rows"])
+                else:
+                    data = encode_cursor(cursor, self.max_rows, self.max_result_bytes, summary=self.summary)
+            finally:
+                cursor.close()
+        otel_trace.get_current_span().set_attribute("truncated", data["truncated"])
 
-        return df.to_dict(orient='records')
+        self.result_cache.put(at_offset(query), data, version)
+        return data
  
 if __name__ == "__main__":
 
@@ -0,0 +1,91 @@
+import re
+import sqlite3
+
+from .system_message import schema_description, sql_instructions
+
+# column descriptions from the hand written schema, keyed by column name
+COLUMN_NOTES = dict(
+    re.findall(r"^\s*#\s+(\w+) \w+ ?(.*)$", schema_description, flags=re.MULTILINE)
+)
+
+# words that show up in questions all the time but never narrow down a category
+STOPWORDS = {
+    "a", "all", "and", "average", "by", "category", "day", "for", "from", "how", "in", "is",
+    "list", "main", "many", "month", "much", "number", "of", "on", "order", "per", "product",
+    "query", "region", "revenue", "s", "sale", "show", "sub", "the", "total", "type", "value",
+    "what", "which", "with", "year",
+}
+
+
+def keywords(text: str) -> set[str]:
+    words = set()
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        # crude singular so "boots" finds "HIKING BOOTS" and "bags" finds "LUGGAGE & BAGS"
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        if word not in STOPWORDS:
+            words.add(word)
+    return words
+
+
+class PromptBuilder:
+
+    """
+    Builds the SQL analyst system prompt from the live database: the table schema,
+    the instructions and a compact category tree. The tree always lists every
+    main_category and sub_category but only spells out the product types of the
+    sub categories the question seems to be about. For the same database and the
+    same matched sub categories the prompt is byte for byte identical, and the
+    static part comes first, so provider side prompt caching can hit.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        columns = connection.execute("PRAGMA table_info(order_data)").fetchall()
+        schema = ["### SQLite table order_data with columns:"]
+        for _, name, column_type, *_ in columns:
+            note = COLUMN_NOTES.get(name, "")
+            schema.append(f"#  {name} {column_type} {note}".rstrip())
+
+        self.regions = [
+            row[0] for row in connection.execute("SELECT DISTINCT Region FROM order_data ORDER BY Region")
+        ]
+
+        self.hierarchy = {}
+        for main_category, sub_category, product_type in connection.execute(
+            "SELECT DISTINCT main_category, sub_category, product_type FROM order_data ORDER BY 1, 2, 3"
+        ):
+            self.hierarchy.setdefault(main_category, {}).setdefault(sub_category, []).append(product_type)
+
+        self.prefix = "\n".join(schema) + "\n\n" + sql_instructions + (
+            "Here are the valid values for the Region: " + " | ".join(self.regions) + "\n\n"
+            "Here are the valid values for main_category, sub_category and product_type as a tree:\n"
+            "MAIN_CATEGORY\n  SUB_CATEGORY: PRODUCT_TYPE | PRODUCT_TYPE ...\n"
+            "Product types are only listed for the sub categories that match the question.\n"
+        )
+
+    def relevant(self, question: str) -> set[tuple[str, str]]:
+        """
+        (main_category, sub_category) pairs whose names or product types share a
+        keyword with the question. A matching main_category brings all its subs.
+        """
+        words = keywords(question)
+        matches = set()
+        for main_category, sub_categories in self.hierarchy.items():
+            main_match = bool(words & keywords(main_category))
+            for sub_category, product_types in sub_categories.items():
+                names = [sub_category] + product_types
+                if main_match or any(words & keywords(name) for name in names):
+                    matches.add((main_category, sub_category))
+        return matches
+
+    def build(self, question: str) -> str:
+        relevant = self.relevant(question)
+        tree = []
+        for main_category, sub_categories in self.hierarchy.items():
+            tree.append(main_category)
+            for sub_category, product_types in sub_categories.items():
+                if (main_category, sub_category) in relevant:
+                    tree.append(f"  {sub_category}: {' | '.join(product_types)}")
+                else:
+                    tree.append(f"  {sub_category}")
+        return self.prefix + "\n".join(tree) + "\n"
@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import pathlib
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from .cache import normalize_question
+
+# Replay backend for model_type "replay": instead of calling a model, completions recorded
+# earlier are served per question, after a configurable simulated latency. Lets the
+# SalesDataInsights pipeline run and be benchmarked without any endpoint.
+#
+# Recordings are JSON lines, one completion each; a question can have several:
+#   {"question": "...", "completion": "SELECT ...", "latency_ms": 812.5, "model": "azure_openai"}
+#
+# REPLAY_LATENCY picks the simulated latency per call:
+#   recorded             the latency_ms recorded with the completion (default)
+#   empirical            a latency_ms drawn from all recordings
+#   none                 no delay
+#   fixed:MS             always MS
+#   uniform:LOW,HIGH     uniform between LOW and HIGH ms
+#   normal:MEAN,SD       normal, never below 0
+#   lognormal:MEDIAN,SIGMA  log-normal with the given median in ms, the usual shape of model latency
+
+DEFAULT_RECORDINGS = os.path.join(pathlib.Path(__file__).parent.resolve(), "data", "replay_recordings.jsonl")
+
+# generate_query() appends this line to the question in the user message
+INSTRUCTION = "\nGive only the query in SQL format"
+
+
+def load_recordings(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_recordings(path: str, recordings: list[dict], append: bool = False) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a" if append else "w") as f:
+        for recording in recordings:
+            f.write(json.dumps(recording) + "\n")
+
+
+class Latency:
+
+    """
+    Simulated latency per call in ms, see REPLAY_LATENCY above for the specs.
+    """
+
+    def __init__(self, spec: str = "recorded", recorded: list[float] = None, seed: int = None):
+        self.spec = spec or "none"
+        self.kind, _, args = self.spec.partition(":")
+        self.args = [float(arg) for arg in args.split(",")] if args else []
+        self.recorded = [ms for ms in recorded or [] if ms is not None]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        expected = {"recorded": 0, "empirical": 0, "none": 0, "fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if self.kind not in expected or len(self.args) != expected[self.kind]:
+            raise ValueError(f"Invalid replay latency {spec!r}")
+
+    def sample(self, recorded_ms: float = None) -> float:
+        with self.lock:
+            if self.kind == "recorded":
+                return recorded_ms or 0.0
+            if self.kind == "empirical":
+                return self.random.choice(self.recorded) if self.recorded else 0.0
+            if self.kind == "fixed":
+                return self.args[0]
+            if self.kind == "uniform":
+                return self.random.uniform(*self.args)
+            if self.kind == "normal":
+                return max(0.0, self.random.gauss(*self.args))
+            if self.kind == "lognormal":
+                median, sigma = self.args
+                return self.random.lognormvariate(math.log(median), sigma)
+            return 0.0
+
+
+class ReplayClient:
+
+    """
+    Stand-in for the AzureOpenAI client: chat.completions.create() answers from the
+    recordings and sleeps for the simulated latency. Thread safe.
+    """
+
+    def __init__(self, recordings: list[dict], latency: Latency, seed: int = None):
+        self.completions = {}
+        for recording in recordings:
+            self.completions.setdefault(normalize_question(recording["question"]), []).append(recording)
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_env(cls, path: str = None) -> "ReplayClient":
+        recordings = load_recordings(path or os.getenv("REPLAY_RECORDINGS", DEFAULT_RECORDINGS))
+        seed = int(os.environ["REPLAY_SEED"]) if os.getenv("REPLAY_SEED") else None
+        latency = Latency(
+            os.getenv("REPLAY_LATENCY", "recorded"),
+            recorded=[recording.get("latency_ms") for recording in recordings],
+            seed=seed,
+        )
+        return cls(recordings, latency, seed=seed)
+
+    def create(self, *, messages: list[dict], **kwargs):
+        content = next(message["content"] for message in reversed(messages) if message["role"] == "user")
+        question = content.removesuffix(INSTRUCTION)
+
+        candidates = self.completions.get(normalize_question(question))
+        if not candidates:
+            raise LookupError(f"No recorded completion for {question!r}")
+        with self.lock:
+            recording = self.random.choice(candidates)
+
+        time.sleep(self.latency.sample(recording.get("latency_ms")) / 1000)
+
+        message = SimpleNamespace(role="assistant", content=recording["completion"])
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+                               model=recording.get("model", "replay"))
+
+
+def record(sales_data_insights, questions: list[str]) -> list[dict]:
+    """
+    Records a completion and its latency for every question from the live model of
+    sales_data_insights. Questions the model fails on are left out.
+    """
+    recordings = []
+    for question in questions:
+        start = time.perf_counter()
+        try:
+            completion = sales_data_insights.generate_query(question)
+        except Exception as e:
+            print(f"Not recorded, {question!r} failed: {e}")
+            continue
+        recordings.append({
+            "question": question,
+            "completion": completion,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "model": sales_data_insights.model_type,
+        })
+    return recordings
+
+
+def recordings_from_test_set(rows: list[dict]) -> list[dict]:
+    # the ground truth query as the completion, the latency then has to come from a distribution
+    return [
+        {"question": row["question"], "completion": row["ground_truth_query"], "latency_ms": None, "model": "ground_truth"}
+        for row in rows
+    ]
@@ -0,0 +1,99 @@
+import json
+import sqlite3
+
+SQL_TYPES = {int: "integer", float: "real", str: "text", bytes: "blob"}
+
+
+def column_type(values: list) -> str:
+    types = {SQL_TYPES.get(type(value), "text") for value in values if value is not None}
+    if types == {"integer", "real"}:
+        return "real"
+    if len(types) == 1:
+        return types.pop()
+    return "null" if not types else "mixed"
+
+
+class ColumnSummary:
+
+    """
+    Running count/min/max/sum of a numeric column, updated one value at a time so it
+    covers every row of the result, including the ones cut off by the caps.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def add(self, value) -> None:
+        if isinstance(value, (int, float)):
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self) -> dict:
+        if self.count == 0:
+            return None
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "sum": self.sum,
+            "mean": self.sum / self.count,
+        }
+
+
+def iter_rows(cursor: sqlite3.Cursor, batch_size: int = 256):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def encode_cursor(cursor: sqlite3.Cursor, max_rows: int, max_bytes: int, summary: bool = False) -> dict:
+    """
+    Reads a query result into a columnar dict: column names once, one value list per
+    column and the column types. At most max_rows rows and about max_bytes of JSON
+    are kept; `truncated` tells whether rows were dropped. With summary=True the rest
+    of the result is still read, without keeping it, to report per column statistics
+    and the total row count.
+    """
+    columns = [description[0] for description in cursor.description]
+    values = [[] for _ in columns]
+    summaries = [ColumnSummary() for _ in columns] if summary else None
+
+    total_rows = 0
+    size = 0
+    truncated = False
+    for row in iter_rows(cursor):
+        total_rows += 1
+        if not truncated:
+            row_size = len(json.dumps(row, default=str))
+            if total_rows > max_rows or size + row_size > max_bytes:
+                truncated = True
+                if not summary:
+                    break
+            else:
+                size += row_size
+                for column_values, value in zip(values, row):
+                    column_values.append(value)
+        if summary:
+            for column_summary, value in zip(summaries, row):
+                column_summary.add(value)
+
+    result = {
+        "columns": columns,
+        "types": [column_type(column_values) for column_values in values],
+        "values": values,
+        "rows": len(values[0]) if values else 0,
+        "truncated": truncated,
+    }
+    if summary:
+        result["total_rows"] = total_rows
+        result["summary"] = {
+            column: column_summary.to_dict() for column, column_summary in zip(columns, summaries)
+        }
+    return result
@@ -0,0 +1,133 @@
+import re
+import sqlite3
+
+# Pre-aggregated copies of order_data. Every measure column keeps its name and holds the
+# SUM over the rolled up rows, so SUM(<measure>) over a rollup is exactly SUM(<measure>)
+# over order_data as long as the query only touches the rollup's dimensions.
+
+MEASURES = [
+    "Number_of_Orders",
+    "Sum_of_Order_Value_USD",
+    "Sum_of_Number_of_Items",
+    "Number_of_Orders_with_Discount",
+    "Sum_of_Discount_Percentage",
+    "Sum_of_Shipping_Cost_USD",
+    "Number_of_Orders_Returned",
+    "Number_of_Orders_Cancelled",
+    "Sum_of_Time_to_Fulfillment",
+    "Number_of_Orders_Repeat_Customers",
+]
+
+DIMENSIONS = [
+    "Year",
+    "Month",
+    "Day",
+    "Date",
+    "Day_of_Week",
+    "main_category",
+    "sub_category",
+    "product_type",
+    "Region",
+]
+
+ROLLUPS = {
+    "order_data_month_region_category": [
+        "Year", "Month", "Region", "main_category", "sub_category", "product_type"
+    ],
+    "order_data_day_region": [
+        "Year", "Month", "Day", "Date", "Day_of_Week", "Region"
+    ],
+}
+
+# single and double quoted SQL literals, quotes escaped by doubling them
+LITERALS = r"'(?:[^']|'')*'" + r'|"(?:[^"]|"")*"'
+
+INDEX_COLUMNS = ["Year", "Month", "Region", "main_category", "sub_category", "product_type"]
+
+
+def build_rollups(connection: sqlite3.Connection) -> None:
+    """
+    Creates the dimension index on order_data and (re)builds the rollup tables.
+    """
+    connection.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_order_data_dimensions ON order_data ({', '.join(INDEX_COLUMNS)})"
+    )
+    sums = ", ".join(f"SUM({measure}) AS {measure}" for measure in MEASURES)
+    for name, dimensions in ROLLUPS.items():
+        columns = ", ".join(dimensions)
+        connection.execute(f"DROP TABLE IF EXISTS {name}")
+        connection.execute(
+            f"CREATE TABLE {name} AS SELECT {columns}, {sums} FROM order_data GROUP BY {columns}"
+        )
+        connection.execute(f"CREATE INDEX idx_{name} ON {name} ({columns})")
+    connection.execute("ANALYZE")
+    connection.commit()
+
+
+def available_rollups(connection: sqlite3.Connection) -> list[str]:
+    """
+    Returns the rollup tables present in the database, smallest first.
+    """
+    tables = {
+        row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    }
+    rollups = [name for name in ROLLUPS if name in tables]
+    return sorted(
+        rollups, key=lambda name: connection.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+    )
+
+
+def rewrite_for_rollup(query: str, rollups: list[str]) -> tuple[str, str]:
+    """
+    Points a query at the first rollup in `rollups` that answers it exactly. Returns the
+    rewritten query and the rollup name, or the original query and None.
+
+    Only single table queries qualify where every measure is used as SUM(<measure>) and
+    every dimension exists in the rollup, and that aggregate, group or use DISTINCT. Row
+    level filters on measures, COUNT(), AVG(), MIN()/MAX(), window functions, SELECT * or
+    sub queries would change the result and are left alone.
+    """
+    columns = {column.lower() for column in MEASURES + DIMENSIONS}
+
+    # SQLite reads "Region" as a column but "APPAREL" as a string, bail out on the former
+    for literal in re.findall(r'"((?:[^"]|"")*)"', query):
+        if literal.lower() in columns:
+            return query, None
+
+    # blank out literals so their content is never mistaken for SQL
+    code = re.sub(LITERALS, "''", query).lower()
+
+    if len(re.findall(r"\bselect\b", code)) != 1 or re.search(r"\bselect\s+(distinct\s+)?\*|[.,]\s*\*", code):
+        return query, None
+    if len(re.findall(r"\border_data\b", code)) != 1 or re.search(r"\bjoin\b", code):
+        return query, None
+    if re.search(r"\b(count|avg|min|max|total|group_concat)\s*\(|\bover\b", code):
+        return query, None
+    # plain row listings would return one row per rollup row instead of per order_data row
+    if not re.search(r"\bdistinct\b|\bgroup\s+by\b|\bsum\s*\(", code):
+        return query, None
+
+    # every measure has to be wrapped directly in SUM()
+    for measure in MEASURES:
+        measure = measure.lower()
+        uses = len(re.findall(rf"\b{measure}\b", code))
+        sums = len(re.findall(rf"\bsum\s*\(\s*{measure}\s*\)", code))
+        if uses != sums:
+            return query, None
+
+    used_dimensions = {
+        dimension for dimension in DIMENSIONS if re.search(rf"\b{dimension.lower()}\b", code)
+    }
+
+    for name in rollups:
+        if used_dimensions <= set(ROLLUPS[name]):
+            # swap the table name, leaving literals untouched
+            rewritten = re.sub(
+                rf"({LITERALS})|\border_data\b",
+                lambda match: match.group(1) or name,
+                query,
+                flags=re.IGNORECASE,
+            )
+            return rewritten, name
+
+    return query, None
@@ -92,7 +92,7 @@ Here are the valid values for the Region:
 [{"Region":"NORTH AMERICA"},{"Region":"EUROPE"},{"Region":"ASIA-PACIFIC"},{"Region":"AFRICA"},{"Region":"MIDDLE EAST"},{"Region":"SOUTH AMERICA"}]
 """
 
-system_message_short = """
+schema_description = """
 ### SQLite table with properties:
     #
     #  Number_of_Orders INTEGER "the number of orders processed"
@@ -115,7 +115,9 @@ system_message_short = """
     #  product_type TEXT
     #  Region TEXT
     #
-In this table all numbers are already aggregated, so all queries will be some type of aggregation with group by.
+"""
+
+sql_instructions = """In this table all numbers are already aggregated, so all queries will be some type of aggregation with group by.
 for instance when asked:
 
 Query the number of orders grouped by Month
@@ -179,6 +181,10 @@ SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "TRAVEL" AND
 To avoid issues with apostrophes, when referring to categories, always use double-quotes, for instance:
 SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "APPAREL" AND sub_category = "MEN'S CLOTHING" AND Month = 5 AND Year = 2024
 
-Here are the valid values for the Region:
+"""
+
+region_values = """Here are the valid values for the Region:
 [{"Region":"NORTH AMERICA"},{"Region":"EUROPE"},{"Region":"ASIA-PACIFIC"},{"Region":"AFRICA"},{"Region":"MIDDLE EAST"},{"Region":"SOUTH AMERICA"}]
-"""
\ No newline at end of file
+"""
+
+system_message_short = schema_description + sql_instructions + region_values
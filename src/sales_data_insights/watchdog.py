@@ -0,0 +1,89 @@
+import re
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class QueryError(Exception):
+
+    """
+    A generated query that was stopped by the watchdog. to_dict() is what the tool
+    reports next to the error message.
+    """
+
+    kind = "error"
+
+    def to_dict(self) -> dict:
+        return {"type": self.kind, "message": str(self)}
+
+
+class QueryTimeout(QueryError):
+    kind = "timeout"
+
+    def __init__(self, timeout: float):
+        super().__init__(f"Query was interrupted after {timeout} seconds, try a more selective question")
+        self.timeout = timeout
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "timeout": self.timeout}
+
+
+class QueryRejected(QueryError):
+    kind = "rejected"
+
+
+def check_plan(connection: sqlite3.Connection, query: str) -> None:
+    """
+    Rejects queries whose plan joins full table scans, i.e. cartesian products like
+    a cross join of order_data with itself. Joining a materialized sub query, like a
+    one row total for a share of total, is fine.
+    """
+    plan = connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+    # CTEs and sub queries in FROM show up as "MATERIALIZE t" or "CO-ROUTINE t" and are
+    # then scanned by that name
+    subqueries = {
+        match.group(1) for _, _, _, detail in plan
+        if (match := re.match(r"(?:MATERIALIZE|CO-ROUTINE) (\w+)", detail))
+    }
+
+    full_scans = defaultdict(list)
+    for _, parent, _, detail in plan:
+        # "SCAN order_data" or "SCAN order_data USING INDEX ...", but not sub queries or constants
+        match = re.match(r"SCAN (\w+)", detail)
+        if match and match.group(1) not in subqueries | {"CONSTANT", "SUBQUERY"}:
+            full_scans[parent].append(match.group(1))
+
+    for tables in full_scans.values():
+        if len(tables) > 1:
+            raise QueryRejected(
+                f"Query would scan {' x '.join(tables)} as a cartesian product, add a join condition or GROUP BY"
+            )
+
+
+@contextmanager
+def deadline(connection: sqlite3.Connection, timeout: float, instructions: int = 10000):
+    """
+    Interrupts whatever runs on the connection inside the block once timeout seconds
+    have passed, raising QueryTimeout.
+    """
+    expires = time.monotonic() + timeout
+    expired = False
+
+    def progress():
+        nonlocal expired
+        # a non zero return value makes SQLite interrupt the running statement
+        if time.monotonic() > expires:
+            expired = True
+            return 1
+        return 0
+
+    connection.set_progress_handler(progress, instructions)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if expired:
+            raise QueryTimeout(timeout) from e
+        raise
+    finally:
+        connection.set_progress_handler(None, 0)
@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Per conversation state of the chainlit app (assistant thread id, trace context of the
+# last message, recent chat history) kept outside of chainlit's in-process user_session.
+# The memory store bounds what a process holds, the SQLite store can be shared by several
+# app worker processes on the same machine so any of them can serve the next message.
+
+
+class MemorySessionStore:
+
+    """
+    In-process session store with LRU and TTL eviction, holds at most max_sessions.
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 24 * 3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> dict:
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self.sessions[session_id]
+                return None
+            self.sessions.move_to_end(session_id)
+            return entry[0]
+
+    def put(self, session_id: str, state: dict) -> None:
+        with self.lock:
+            self.sessions[session_id] = (state, time.time())
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteSessionStore:
+
+    """
+    Session store in a SQLite file, states are stored as JSON and expire ttl seconds
+    after their last update. WAL mode lets several processes read and write it.
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 3600, expire_interval: float = 60):
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self.last_expired = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT, updated REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated)")
+        self.db.commit()
+
+    def get(self, session_id: str) -> dict:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state FROM sessions WHERE id = ? AND updated >= ?",
+                (session_id, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id: str, state: dict) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions (id, state, updated) VALUES (?, ?, ?)",
+                (session_id, json.dumps(state), now),
+            )
+            # expired sessions are cleaned up now and then, not on every write
+            if now - self.last_expired > self.expire_interval:
+                self.db.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+                self.last_expired = now
+            self.db.commit()
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+_store = None
+_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Process wide session store, SESSION_STORE picks the backend ("memory" or "sqlite").
+    """
+    global _store
+    with _lock:
+        if _store is None:
+            ttl = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+            if os.getenv("SESSION_STORE", "memory") == "sqlite":
+                _store = SqliteSessionStore(os.getenv("SESSION_STORE_PATH", "sessions.db"), ttl=ttl)
+            else:
+                _store = MemorySessionStore(max_sessions=int(os.getenv("SESSION_MAX", "1000")), ttl=ttl)
+        return _store
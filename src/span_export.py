@@ -0,0 +1,146 @@
+import os
+import threading
+from typing import Sequence
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import StatusCode
+
+# Span export pipeline for the app. Spans are handed to batch processors that export
+# from a background thread, so ending a span on the request path only costs a queue
+# append. Everything can be tuned through environment variables:
+#
+#   TRACE_SAMPLE_RATIO         head sampling, fraction of traces that are recorded at all
+#   TRACE_KEEP_RATIO           tail sampling, fraction of recorded traces that are exported,
+#                              spans with errors or slower than TRACE_KEEP_SLOWER_THAN_MS always are
+#   SPAN_EXPORT_QUEUE_SIZE     spans buffered per exporter before new ones are dropped
+#   SPAN_EXPORT_BATCH_SIZE     spans per export call
+#   SPAN_EXPORT_INTERVAL_MS    how often the buffer is flushed
+#   SPANS_FILE                 local span file, empty to disable, rotated at SPANS_FILE_MAX_BYTES
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def sampler() -> ParentBased:
+    # child spans follow the decision of their root, so sampled traces stay complete
+    return ParentBased(TraceIdRatioBased(env_float("TRACE_SAMPLE_RATIO", 1.0)))
+
+
+def batch_processor(exporter: SpanExporter) -> BatchSpanProcessor:
+    return BatchSpanProcessor(
+        exporter,
+        max_queue_size=env_int("SPAN_EXPORT_QUEUE_SIZE", 2048),
+        max_export_batch_size=env_int("SPAN_EXPORT_BATCH_SIZE", 512),
+        schedule_delay_millis=env_int("SPAN_EXPORT_INTERVAL_MS", 5000),
+    )
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+
+    """
+    Forwards finished spans to processor when they are interesting: spans that
+    failed or took longer than keep_slower_than seconds are always kept, the others
+    only for keep_ratio of the traces. The ratio is decided by trace id, so a kept
+    trace keeps all its ordinary spans.
+    """
+
+    def __init__(self, processor: SpanProcessor, keep_ratio: float = 1.0, keep_slower_than: float = 1.0):
+        self.processor = processor
+        self.keep_ratio = keep_ratio
+        self.keep_slower_than = keep_slower_than
+        self.bound = round(keep_ratio * (2 ** 64 - 1))
+
+    def keep(self, span: ReadableSpan) -> bool:
+        if self.keep_ratio >= 1.0:
+            return True
+        if span.status.status_code == StatusCode.ERROR:
+            return True
+        if span.end_time and span.start_time and (span.end_time - span.start_time) / 1e9 >= self.keep_slower_than:
+            return True
+        # same rule as TraceIdRatioBased, on the lower 64 bits of the trace id
+        return span.context.trace_id & 0xFFFFFFFFFFFFFFFF < self.bound
+
+    def on_start(self, span: Span, parent_context: Context = None) -> None:
+        self.processor.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if self.keep(span):
+            self.processor.on_end(span)
+
+    def shutdown(self) -> None:
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.processor.force_flush(timeout_millis)
+
+
+def tail_sampled(processor: SpanProcessor) -> SpanProcessor:
+    return TailSamplingSpanProcessor(
+        processor,
+        keep_ratio=env_float("TRACE_KEEP_RATIO", 1.0),
+        keep_slower_than=env_float("TRACE_KEEP_SLOWER_THAN_MS", 1000) / 1000,
+    )
+
+
+class RotatingFileSpanExporter(SpanExporter):
+
+    """
+    Appends spans as JSON lines through a buffered file, flushed once per exported
+    batch. When the file grows beyond max_bytes it is rotated to path.1, path.2, ...
+    keeping backup_count old files.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3,
+                 buffer_size: int = 64 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.file = open(path, "w", encoding="utf-8", buffering=buffer_size)
+
+    def rotate(self) -> None:
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8", buffering=self.buffer_size)
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self.lock:
+            for span in spans:
+                self.file.write(span.to_json(indent=None) + "\n")
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        with self.lock:
+            self.file.close()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self.lock:
+            self.file.flush()
+        return True
+
+
+def spans_file_exporter() -> RotatingFileSpanExporter | None:
+    path = os.getenv("SPANS_FILE", "spans.json")
+    if not path:
+        return None
+    return RotatingFileSpanExporter(
+        path,
+        max_bytes=env_int("SPANS_FILE_MAX_BYTES", 10 * 1024 * 1024),
+        backup_count=env_int("SPANS_FILE_BACKUP_COUNT", 3),
+    )
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+# Startup report: how long importing the app takes, per top level package as measured
+# by `python -X importtime`, and how long each warm-up step takes. With --baseline the
+# numbers are compared against a saved report so import time regressions are visible.
+#
+#   python startup_report.py --module app --save startup_baseline.json
+#   python startup_report.py --module app --baseline startup_baseline.json
+
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def import_times(module: str) -> dict:
+    """
+    Imports module in a fresh interpreter and returns its total import time and the
+    cumulative time of every module it imports directly, in ms. Interpreter startup
+    imports (site, encodings, ...) are left out.
+    """
+    # no warm-up threads or .env side effects in the measured interpreter
+    env = {**os.environ, "WARMUP": ""}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    targets = {name.strip() for name in module.split(",")}
+    packages = {}
+    total = 0
+    children = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        # -X importtime indents nested imports by two spaces per level and lists
+        # every module after the modules it imported
+        depth = len(indent) // 2
+        if depth == 1:
+            children.append((name, int(cumulative)))
+        elif depth == 0:
+            if name in targets:
+                total += int(cumulative)
+                for child, child_cumulative in children:
+                    packages[child] = packages.get(child, 0) + child_cumulative / 1000
+            children = []
+    return {"total_ms": total / 1000, "packages_ms": packages}
+
+
+def report(module: str, warm: bool, top: int) -> dict:
+    result = {"module": module, **import_times(module)}
+
+    if warm:
+        from warmup import warm_up
+        result["warm_up_s"] = warm_up()
+
+    print(f"import {module}: {result['total_ms']:.0f} ms")
+    for name, ms in sorted(result["packages_ms"].items(), key=lambda item: -item[1])[:top]:
+        print(f"  {ms:8.1f} ms  {name}")
+    for step, seconds in result.get("warm_up_s", {}).items():
+        print(f"warm-up {step}: {seconds * 1000:.0f} ms")
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if result["total_ms"] > baseline["total_ms"] * (1 + tolerance):
+        regressions.append(f"total import time {baseline['total_ms']:.0f} -> {result['total_ms']:.0f} ms")
+    for name, ms in result["packages_ms"].items():
+        before = baseline["packages_ms"].get(name)
+        # small packages jitter too much to compare, new ones show up if they are expensive
+        if before is None and ms > 50:
+            regressions.append(f"new import {name}: {ms:.0f} ms")
+        elif before is not None and ms > 10 and ms > before * (1 + tolerance):
+            regressions.append(f"{name}: {before:.0f} -> {ms:.0f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", help="Module whose import is measured", default="app")
+    parser.add_argument("--top", help="Number of packages to list", type=int, default=15)
+    parser.add_argument("--warm-up", help="Also run and time the warm-up steps", action="store_true")
+    parser.add_argument("--save", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a report saved with --save")
+    parser.add_argument("--tolerance", help="Allowed relative slowdown", type=float, default=0.25)
+    args = parser.parse_args()
+
+    result = report(args.module, args.warm_up, args.top)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,78 @@
+import logging
+import os
+import threading
+import time
+
+# Optional warm-up of the chat app. Instead of the first user message paying for client
+# creation, reading order_data.db and building the analyst prompt, these run once when
+# the app starts. WARMUP lists the steps to run, comma separated, empty disables it.
+
+WARMUP_STEPS = ["clients", "db", "prompt"]
+
+
+def warm_clients() -> None:
+    from sales_data_insights.clients import get_async_client, get_client
+    get_client("azure_openai")
+    # the SalesDataInsights tool retries itself and uses its own client without SDK retries
+    get_client("azure_openai", max_retries=0)
+    get_async_client()
+
+
+def warm_db() -> None:
+    from assistant_flow.chat import get_tools
+    sales_data_insights = get_tools()["sales_data_insights"]
+
+    # read the file once so its pages are in the OS page cache, up to WARMUP_DB_MAX_BYTES
+    max_bytes = int(os.getenv("WARMUP_DB_MAX_BYTES", str(1024 * 1024 * 1024)))
+    with open(sales_data_insights.data, "rb") as f:
+        read = 0
+        while read < max_bytes:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            read += len(chunk)
+
+    # connections are per thread, one opened here would never serve a request, so the
+    # requests open their own against the warm page cache
+
+
+def warm_prompt() -> None:
+    from assistant_flow.chat import get_tools
+    sales_data_insights = get_tools()["sales_data_insights"]
+    sales_data_insights.prompt_builder()
+    sales_data_insights.fast_path_matcher()
+
+
+STEPS = {
+    "clients": warm_clients,
+    "db": warm_db,
+    "prompt": warm_prompt,
+}
+
+
+def warm_up(steps: list[str] = None) -> dict[str, float]:
+    """
+    Runs the warm-up steps and returns how long each one took in seconds. A failing
+    step is logged and skipped, the app then just warms up on first use.
+    """
+    if steps is None:
+        steps = [step for step in os.getenv("WARMUP", ",".join(WARMUP_STEPS)).split(",") if step.strip()]
+
+    timings = {}
+    for step in steps:
+        start = time.perf_counter()
+        try:
+            STEPS[step.strip()]()
+        except Exception:
+            logging.exception(f"Warm-up step {step} failed")
+            continue
+        timings[step.strip()] = time.perf_counter() - start
+        logging.info(f"Warm-up step {step} took {timings[step.strip()]:.3f}s")
+    return timings
+
+
+def warm_up_in_background(steps: list[str] = None) -> threading.Thread:
+    # the app is serving while this runs, a message that arrives early just does the work itself
+    thread = threading.Thread(target=warm_up, args=(steps,), name="warm_up", daemon=True)
+    thread.start()
+    return thread